@@ -1,5 +1,15 @@
-from datetime import datetime,timedelta
-import csv
+from datetime import timedelta
+import numpy as np
+
+from support.record_columns import RecordFilter, load_record_columns, parse_time_prefix_seconds, unix_epoch
+
+""" Epochs of an anticipate run, read from the engines' record files.
+    Each record file is loaded once as columns (see support.record_columns),
+    keeping just its spike and synapse adjustment rows.  Spikes become
+    events, and an epoch is the range of events from one spike of the
+    epoch neuron up to the next.  Epochs, events and adjustments are
+    lightweight views onto those shared arrays, made as they are accessed.
+"""
 
 class EventTypes:
   Decay_Event = 1
@@ -16,48 +26,67 @@ class AnticipateAdjustment:
     print('        Adjustment to neuron/synapse' + str(self.neuron_index) + '/' + str(self.synapse_index) + ' to strength ' + str(self.synapse_strength))
 
 class AnticipateEvent:
-  def __init__(self, row=None):
-    if row:
-      self.tick = int(row['tick'])
-      self.parse_time(row['time'])
-      self.neuron_index = int(row['Neuron-Index'])
-      self.type = int(row['Neuron-Event-Type'])
+  def __init__(self, record=None, index=None):
+    """ The spike event at index in the record, or an empty event if no record is given.
+    """
     self.synapse_adjustments = []
-
-  def _add_adjustment(self, row):
-    self.synapse_adjustments.append(AnticipateAdjustment(int(row['Neuron-Index']), int(row['Synapse-Index']), int(row['Synapse-Strength'])))
+    if record is not None:
+      self.tick = int(record.ticks[index])
+      self.time = int(record.times[index])
+      self.neuron_index = int(record.neuron_indices[index])
+      self.type = EventTypes.Spike_Event
+      self.synapse_adjustments = record.get_adjustments(index)
 
   def parse_time(self, timeString):
     dotPos = timeString.find('.')
-    self.datetime = datetime.strptime(timeString[:dotPos], '%Y-%m-%d %H:%M:%S')
-    self.nanosecond = int(timeString[dotPos+1:])
+    self.time = parse_time_prefix_seconds(timeString[:dotPos]) * 1000000000 + int(timeString[dotPos+1:])
 
   def to_delta(self):
-    return timedelta(days=self.datetime.day, 
-                     hours=self.datetime.hour, 
-                     minutes=self.datetime.minute, 
-                     seconds=self.datetime.second, 
-                     microseconds=round(self.nanosecond/1000))
+    moment = unix_epoch + timedelta(seconds=self.time // 1000000000)
+    nanosecond = self.time % 1000000000
+    return timedelta(days=moment.day,
+                     hours=moment.hour,
+                     minutes=moment.minute,
+                     seconds=moment.second,
+                     microseconds=round(nanosecond/1000))
 
   def print(self):
     print('      Event type ' + str(self.type) + ' for neuron ' + str(self.neuron_index) + ' at tick ' + str(self.tick) + ' with ' + str(len(self.synapse_adjustments)) + ' adjustments')
     for adjustment in self.synapse_adjustments:
       adjustment.print()
 
+class AnticipateEvents:
+  """ The events of one epoch, as a read-only sequence of AnticipateEvent views.
+  """
+  def __init__(self, record, first, end):
+    self.record = record
+    self.first = first
+    self.end = end
+
+  def __len__(self):
+    return self.end - self.first
+
+  def __getitem__(self, position):
+    if isinstance(position, slice):
+      return [self[index] for index in range(*position.indices(len(self)))]
+    if position < 0:
+      position += len(self)
+    if position < 0 or position >= len(self):
+      raise IndexError('event index out of range')
+    return AnticipateEvent(self.record, self.first + position)
+
+  def __iter__(self):
+    for index in range(self.first, self.end):
+      yield AnticipateEvent(self.record, index)
+
 class AnticipateEpoch:
-  def __init__(self, engine_name, row):
-    self.engine_name = engine_name
-    self.events = []
-    self.last_event = None
-    self.add_event(row)
-
-  def add_event(self, row):
-    if int(row['Neuron-Event-Type']) == EventTypes.Adjust_Event:
-      if self.last_event:
-        self.last_event._add_adjustment(row)
-    elif int(row['Neuron-Event-Type']) == EventTypes.Spike_Event:
-      self.last_event = AnticipateEvent(row)
-      self.events.append(self.last_event)
+  def __init__(self, record, first, end):
+    """ The events of record from index first up to end.
+    """
+    self.engine_name = record.engine_name
+    self.first_event = first
+    self.end_event = end
+    self.events = AnticipateEvents(record, first, end)
 
   def print(self):
     print('    Epoch has ' + str(len(self.events)) + ' events')
@@ -65,35 +94,96 @@ class AnticipateEpoch:
       event.print()
 
 
+class AnticipateRecord:
+  """ The spikes and synapse adjustments of one engine's record file, as
+      shared arrays.  Each spike is an event, owning the adjustments that
+      follow it in the record up to the next spike.
+  """
+  def __init__(self, engine_name, filename, epoch_index, use_cache=True):
+    self.engine_name = engine_name
+    columns = load_record_columns(filename, use_cache, RecordFilter(event_types=[EventTypes.Spike_Event, EventTypes.Adjust_Event]))
+    spike_positions = np.flatnonzero(columns['event_type'] == EventTypes.Spike_Event)
+    adjust_positions = np.flatnonzero(columns['event_type'] == EventTypes.Adjust_Event)
+
+    self.ticks = columns['tick'][spike_positions]
+    self.times = columns['time'][spike_positions]
+    self.neuron_indices = columns['neuron_index'][spike_positions]
+    self.adjustment_ticks = columns['tick'][adjust_positions]
+    self.adjustment_neurons = columns['neuron_index'][adjust_positions]
+    self.adjustment_synapses = columns['synapse_index'][adjust_positions]
+    self.adjustment_strengths = columns['synapse_strength'][adjust_positions]
+    # Event i owns adjustments adjustment_bounds[i] up to adjustment_bounds[i + 1].
+    self.adjustment_bounds = np.searchsorted(adjust_positions, np.append(spike_positions, len(columns)))
+
+    # Each spike of the epoch neuron starts an epoch, which runs to the next.
+    self.epoch_starts = np.flatnonzero(self.neuron_indices == int(epoch_index))
+    self.epoch_ends = np.append(self.epoch_starts[1:], len(self.ticks))
+    self.epochs = [AnticipateEpoch(self, first, end) for first, end in zip(self.epoch_starts.tolist(), self.epoch_ends.tolist())]
+    self.strength_index = None
+
+  def get_adjustments(self, index):
+    first, end = self.adjustment_bounds[index], self.adjustment_bounds[index + 1]
+    return [AnticipateAdjustment(int(neuron), int(synapse), int(strength)) for neuron, synapse, strength in
+      zip(self.adjustment_neurons[first:end], self.adjustment_synapses[first:end], self.adjustment_strengths[first:end])]
+
+  def build_strength_index(self):
+    """ Map each (neuron index, synapse index) adjusted within the epochs
+        to the ticks and strengths of its adjustments, in record order.
+        An adjustment's neuron is that of the spike event owning it.
+    """
+    first = self.adjustment_bounds[self.epochs[0].first_event] if self.epochs else len(self.adjustment_ticks)
+    owners = np.repeat(self.neuron_indices, np.diff(self.adjustment_bounds))
+    neurons = owners[first - self.adjustment_bounds[0]:].astype(np.int64)
+    synapses = self.adjustment_synapses[first:].astype(np.int64)
+    keys = (neurons << 32) | (synapses & 0xffffffff)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    # Each run of equal keys in sorted order is one synapse's trajectory.
+    starts = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+    if len(keys) > 0:
+      starts = np.concatenate(([0], starts))
+    ends = np.append(starts[1:], len(keys))
+
+    ticks = self.adjustment_ticks[first:]
+    strengths = self.adjustment_strengths[first:]
+    self.strength_index = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+      positions = order[start:end]
+      key = (int(neurons[positions[0]]), int(synapses[positions[0]]))
+      self.strength_index[key] = (ticks[positions], strengths[positions])
+
+  def get_strength_trajectory(self, neuron, synapse):
+    """ Return the ticks and strengths of the adjustments to synapse owned
+        by spikes of neuron within the epochs, in time order.  Both are empty if the
+        synapse was never adjusted.
+    """
+    if self.strength_index is None:
+      self.build_strength_index()
+    trajectory = self.strength_index.get((int(neuron), int(synapse)))
+    if trajectory is None:
+      return self.adjustment_ticks[:0], self.adjustment_strengths[:0]
+    return trajectory
+
+
 class AnticipateRun:
   record_path = '/record/test/test/{engineName}/ModelEngineRecord.csv'
 
-  def __init__(self, engines, epoch_index):
+  def __init__(self, engines, epoch_index, record_path=None, use_cache=True):
+    """ Read the epochs of each engine's record file.  record_path is the
+        path of a record file, with '{engineName}' standing for the engine
+        name (default: AnticipateRun.record_path).
+    """
     self.engines = engines
+    self.record_path = record_path if record_path else AnticipateRun.record_path
+    self.engine_records = []
     self.records = []
 
     for engine in self.engines:
-      epoch = None
-      epochs = []
       filename = self.record_path.format(engineName = engine)
       print('Analyzing reccord file at ' + filename)
-
-      with open(filename, newline='') as recordFile:
-        reader = csv.DictReader(recordFile)
-        for row in reader:
-          if int(row['Neuron-Index']) == epoch_index and int(row['Neuron-Event-Type']) == EventTypes.Spike_Event:
-            if epoch:
-              epochs.append(epoch)
-              epoch = None
-            epoch = AnticipateEpoch(engine, row)
-          else:
-            if epoch:
-              epoch.add_event(row)
-
-      if epoch:
-        epochs.append(epoch)
-
-      self.records.append(epochs)
+      record = AnticipateRecord(engine, filename, epoch_index, use_cache)
+      self.engine_records.append(record)
+      self.records.append(record.epochs)
 
   def print(self):
     print('AnticipateRun object has ' + str(len(self.records)) + ' record files')
@@ -103,4 +193,4 @@ class AnticipateRun:
         epoch.print()
 
 
-#run = AnticipateRun('/media/louis/seagate8T/record/test/test/Research1/ModelEngineRecord.csv', 1)
+#run = AnticipateRun(['Research1'], 1, '/media/louis/seagate8T/record/test/test/{engineName}/ModelEngineRecord.csv')
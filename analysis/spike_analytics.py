@@ -0,0 +1,108 @@
+import numpy as np
+
+""" Spike train measures over whole runs, computed on the shared event
+    arrays of an AnticipateRecord (see analysis.anticipate_record) rather
+    than event by event.  Spike trains are the ticks of one neuron's
+    spikes, in record order.  Epochs are those of the record: from one
+    spike of the epoch neuron up to the next.
+"""
+
+def get_spike_positions(record, neurons=None):
+  """ Map each neuron (default: every neuron that spiked) to the positions
+      of its spikes in the record's event arrays.
+  """
+  order = np.argsort(record.neuron_indices, kind='stable')
+  sorted_neurons = record.neuron_indices[order]
+  if neurons is None:
+    neurons = np.unique(sorted_neurons).tolist()
+
+  positions = {}
+  for neuron in neurons:
+    first = np.searchsorted(sorted_neurons, int(neuron), side='left')
+    end = np.searchsorted(sorted_neurons, int(neuron), side='right')
+    positions[int(neuron)] = order[first:end]
+  return positions
+
+def get_spike_trains(record, neurons=None):
+  """ Map each neuron (default: every neuron that spiked) to the ticks of its spikes.
+  """
+  return { neuron: record.ticks[positions] for neuron, positions in get_spike_positions(record, neurons).items() }
+
+def get_spike_times(record, neurons=None):
+  """ Map each neuron (default: every neuron that spiked) to the times of
+      its spikes, in nanoseconds (see support.record_columns).
+  """
+  return { neuron: record.times[positions] for neuron, positions in get_spike_positions(record, neurons).items() }
+
+def get_interspike_intervals(spike_trains):
+  """ Map each neuron of spike_trains to the intervals between its consecutive spikes.
+  """
+  return { neuron: np.diff(train) for neuron, train in spike_trains.items() }
+
+def get_firing_rates(spike_trains, window, step=1, first_tick=None, end_tick=None):
+  """ Count each neuron's spikes in windows of window ticks, starting every
+      step ticks from first_tick up to end_tick (default: the first and
+      last spike of any train).  Return the first tick of each window and
+      a windows x neurons matrix of rates in spikes per tick, with the
+      neurons in the order of spike_trains.
+  """
+  trains = list(spike_trains.values())
+  if first_tick is None:
+    first_tick = min((int(train[0]) for train in trains if len(train) > 0), default=0)
+  if end_tick is None:
+    end_tick = max((int(train[-1]) + 1 for train in trains if len(train) > 0), default=first_tick)
+
+  window_ticks = np.arange(first_tick, max(end_tick - window + 1, first_tick + 1), step)
+  rates = np.empty((len(window_ticks), len(trains)), dtype=np.float64)
+  for column, train in enumerate(trains):
+    counts = np.searchsorted(train, window_ticks + window, side='left') - np.searchsorted(train, window_ticks, side='left')
+    rates[:, column] = counts / window
+  return window_ticks, rates
+
+def get_spike_latencies(source_train, target_train, max_latency=None):
+  """ For each spike of source_train, the ticks until the first spike of
+      target_train at or after it.  Spikes with no such target spike, or
+      none within max_latency ticks, have latency -1.
+  """
+  following = np.searchsorted(target_train, source_train, side='left')
+  found = following < len(target_train)
+  latencies = np.full(len(source_train), -1, dtype=np.int64)
+  latencies[found] = target_train[following[found]] - source_train[found]
+  if max_latency is not None:
+    latencies[latencies > max_latency] = -1
+  return latencies
+
+def get_cross_correlogram(source_train, target_train, max_lag):
+  """ Count the pairs of a source spike and a target spike by lag (target
+      tick minus source tick), from -max_lag to max_lag.  Return the lags
+      and their counts.
+  """
+  first = np.searchsorted(target_train, source_train - max_lag, side='left')
+  end = np.searchsorted(target_train, source_train + max_lag, side='right')
+  pair_counts = end - first
+  total = int(pair_counts.sum())
+
+  # The target of each pair, taking each source spike's targets in turn.
+  pair_starts = np.cumsum(pair_counts) - pair_counts
+  targets = np.repeat(first, pair_counts) + np.arange(total) - np.repeat(pair_starts, pair_counts)
+  lags = target_train[targets] - np.repeat(source_train, pair_counts)
+
+  counts = np.bincount(lags + max_lag, minlength=2 * max_lag + 1) if total > 0 else np.zeros(2 * max_lag + 1, dtype=np.int64)
+  return np.arange(-max_lag, max_lag + 1), counts
+
+def get_epoch_first_spikes(record, neurons):
+  """ For each epoch of the record, the ticks from the epoch's trigger
+      spike to the first spike of each neuron within the epoch.  Return
+      an epochs x neurons matrix, with -1 where the neuron did not spike
+      in the epoch.
+  """
+  trigger_ticks = record.ticks[record.epoch_starts]
+  latencies = np.full((len(record.epoch_starts), len(neurons)), -1, dtype=np.int64)
+  spike_positions = get_spike_positions(record, neurons)
+  for column, neuron in enumerate(neurons):
+    positions = spike_positions[int(neuron)]
+    following = np.searchsorted(positions, record.epoch_starts, side='left')
+    found = following < len(positions)
+    found[found] = positions[following[found]] < record.epoch_ends[found]
+    latencies[found, column] = record.ticks[positions[following[found]]] - trigger_ticks[found]
+  return latencies
@@ -0,0 +1,128 @@
+import numpy as np
+
+from support.record_columns import iter_record_columns
+
+""" Wall-clock duration of every tick of a run, from the tick and time
+    columns of the engines' record files.  A tick starts at the time of
+    its first record row, and lasts until the start of the next tick
+    observed.  Where ticks have no rows, the interval up to the next
+    observed tick is shared evenly between the ticks it spans.  Engine
+    periods are in microseconds, as in the engine configuration
+    ('period', sent to the engine as 'engineperiod').
+"""
+
+default_record_path = '/record/test/test/{engineName}/ModelEngineRecord.csv'
+default_chunk_size = 1 << 20
+default_percentiles = [50, 90, 99, 99.9]
+
+def get_tick_starts(filename, chunk_size=default_chunk_size, use_cache=True):
+  """ Return each tick observed in the record file, and the time it
+      started in nanoseconds (see support.record_columns).  The record
+      is read a chunk at a time.
+  """
+  ticks = []
+  times = []
+  for records in iter_record_columns(filename, chunk_size, use_cache):
+    if len(records) == 0:
+      continue
+    starts = np.flatnonzero(np.concatenate(([True], records['tick'][1:] != records['tick'][:-1])))
+    ticks.append(records['tick'][starts])
+    times.append(np.minimum.reduceat(records['time'], starts))
+
+  if not ticks:
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+  # A tick split across two chunks appears twice; keep its earliest time.
+  ticks = np.concatenate(ticks)
+  times = np.concatenate(times)
+  starts = np.flatnonzero(np.concatenate(([True], ticks[1:] != ticks[:-1])))
+  return ticks[starts], np.minimum.reduceat(times, starts)
+
+def get_tick_durations(ticks, times):
+  """ Return the ticks spanned by each interval between consecutive
+      observed ticks, and the duration per tick of each interval in
+      microseconds.
+  """
+  spans = np.diff(ticks)
+  return spans, np.diff(times) / (spans * 1000.0)
+
+
+class TickLatencyReport:
+  """ Tick duration statistics for one engine's record file: a histogram,
+      percentiles, the worst stalls, and the drift of the elapsed time
+      from the engine period.
+  """
+  def __init__(self, engine_name, filename, engine_period, bins=40, histogram_periods=4, worst_count=10, overrun_tolerance=0.1, use_cache=True):
+    """ The histogram has bins equal bins from zero up to histogram_periods
+        engine periods, with longer ticks counted as overflow.  A tick
+        overruns if it lasts more than overrun_tolerance over the period.
+    """
+    self.engine_name = engine_name
+    self.filename = filename
+    self.engine_period = engine_period
+
+    self.ticks, self.times = get_tick_starts(filename, use_cache=use_cache)
+    self.spans, self.durations = get_tick_durations(self.ticks, self.times)
+    self.tick_count = int(self.spans.sum())
+
+    self.histogram_edges = np.linspace(0, histogram_periods * engine_period, bins + 1)
+    self.histogram, _ = np.histogram(self.durations, self.histogram_edges, weights=self.spans)
+    self.histogram_overflow = int(self.spans[self.durations > self.histogram_edges[-1]].sum())
+
+    self.percentiles = {}
+    if self.tick_count > 0:
+      # Weighted by span, so every tick counts once.
+      order = np.argsort(self.durations)
+      cumulative = np.cumsum(self.spans[order])
+      for percentile in default_percentiles:
+        position = np.searchsorted(cumulative, percentile / 100.0 * self.tick_count, side='left')
+        self.percentiles[percentile] = float(self.durations[order[min(position, len(order) - 1)]])
+    self.mean = float(np.sum(self.durations * self.spans) / self.tick_count) if self.tick_count > 0 else 0.0
+    self.maximum = float(self.durations.max()) if self.tick_count > 0 else 0.0
+    self.overrun_count = int(self.spans[self.durations > engine_period * (1 + overrun_tolerance)].sum())
+
+    # The worst stalls: intervals with the longest duration per tick.
+    worst = np.argsort(self.durations, kind='stable')[::-1][:worst_count]
+    self.worst_stalls = [(int(self.ticks[interval]), int(self.spans[interval]), float(self.durations[interval])) for interval in worst]
+
+    # Elapsed time less the time the ticks should have taken, at the start of each observed tick.
+    self.drift = (self.times - self.times[0]) / 1000.0 - (self.ticks - self.ticks[0]) * float(engine_period) if len(self.ticks) > 0 else np.empty(0)
+    self.final_drift = float(self.drift[-1]) if len(self.drift) > 0 else 0.0
+
+  def print(self):
+    print('Engine ' + self.engine_name + ': ' + str(self.tick_count) + ' ticks with period ' + str(self.engine_period) + ' us')
+    if self.tick_count == 0:
+      return
+
+    print(f'  mean {self.mean:.1f} us, max {self.maximum:.1f} us, ' + str(self.overrun_count) + ' ticks overran')
+    print('  ' + ', '.join(f'p{percentile:g} {duration:.1f} us' for percentile, duration in self.percentiles.items()))
+    print(f'  drift {self.final_drift:.1f} us at end ({self.final_drift * 1000 / self.tick_count:.2f} us per 1000 ticks), max {self.drift.max():.1f} us')
+
+    print('  Histogram (us per tick):')
+    peak = max(int(self.histogram.max()), self.histogram_overflow, 1)
+    for count, first, end in zip(self.histogram, self.histogram_edges[:-1], self.histogram_edges[1:]):
+      print(f'    {first:9.1f} - {end:9.1f} {int(count):9d} ' + '#' * round(50 * count / peak))
+    print(f'    {self.histogram_edges[-1]:9.1f} +           {self.histogram_overflow:9d} ' + '#' * round(50 * self.histogram_overflow / peak))
+
+    print('  Worst stalls:')
+    for tick, span, duration in self.worst_stalls:
+      print(f'    tick {tick:9d}: {duration:10.1f} us per tick over ' + str(span) + ' ticks')
+
+
+class TickLatencyRun:
+  def __init__(self, engines, record_path=None, use_cache=True, **kwargs):
+    """ Report the tick latency of each engine, given as dicts with 'name'
+        and 'period' fields.  record_path is the path of a record file, with
+        '{engineName}' standing for the engine name (default:
+        default_record_path); kwargs are passed on to TickLatencyReport.
+    """
+    self.record_path = record_path if record_path else default_record_path
+    self.reports = []
+    for engine in engines:
+      filename = self.record_path.format(engineName = engine['name'])
+      print('Timing ticks in record file at ' + filename)
+      self.reports.append(TickLatencyReport(engine['name'], filename, engine['period'], use_cache=use_cache, **kwargs))
+
+  def print(self):
+    for report in self.reports:
+      report.print()
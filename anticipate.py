@@ -6,7 +6,7 @@ from anticipate_data import template, spikePattern, NeuronAssignments
 from support.model_utilities import templateNeuronCount, stepAndRepeat, extract_monitor_neurons
 from support.configuration import Configuration
 from support.model_manager import ModelManager
-from clean_record import Cleaner
+from clean_record import Cleaner, TriggerSpec, NeuronRecordType
 from plot_record import plot_cleaned_run,plot_epochs
 
 engines_1 = [{ 'name': 'Research1.lan', 'period': 10000}]
@@ -79,8 +79,8 @@ class Anticipate:
         index_map[index].append(index + deployment['offset'])
 
     print(index_map)
-    is_trigger = lambda sample: sample['Neuron-Event-Type'] == 2 and sample['Neuron-Index'] in index_map[NeuronAssignments.In1]
-    cleaner = Cleaner(self.configuration, extract_monitor_neurons(self.configuration, NeuronAssignments, monitor_i_n), is_trigger)
+    trigger = TriggerSpec(event_types=[NeuronRecordType.Spike.value], neurons=index_map[NeuronAssignments.In1])
+    cleaner = Cleaner(self.configuration, extract_monitor_neurons(self.configuration, NeuronAssignments, monitor_i_n), trigger)
     cleaner.clean_data()
 
     plot_cleaned_run(self.configuration)
@@ -1,15 +1,21 @@
 import os
-import sys
-import copy
 import json
 import time
 import csv
 import re
+import shutil
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
-from datetime import datetime,timedelta
+from datetime import timedelta
+import numpy as np
 
 from support.configuration import Configuration
+from support.clean_run import CleanRunWriter, iter_clean_run, write_epoch_tensor
+from support.record_index import get_first_tick, iter_record_window
+from support.record_columns import NOT_AVAILABLE, RecordFilter, RecordTail, read_first_tick, iter_record_columns, filter_records, load_record_files, empty_records, offset_records, merge_records, merge_record_streams, record_sample, unix_epoch
 
 '''
 Extract the configured channels from the record CSV file
@@ -26,265 +32,1312 @@ class NeuronRecordType(Enum):
 
 
 class RecordFileParser:
-    def __init__(self, configuration, deployment):
+    default_chunk_size = 10000
+
+    def __init__(self, configuration, deployment, streaming=False, chunk_size=None, use_cache=True, record_filter=None):
+      ''' When streaming is set, the record file is read lazily, chunk_size
+          rows at a time, rather than loaded whole into memory.
+          When use_cache is set, record columns are served from the
+          memory-mapped sidecar written by the first parse.
+          record_filter (a RecordFilter, in synchronized ticks and offset
+          neuron indexes) drops unwanted rows as the columns are parsed.
+      '''
       self.configuration = configuration
       self.record_path = self.configuration.find_record_path()
       self.deployment_path = self.record_path + '/' + str(deployment['engine'])
       self.deployment_offset = int(deployment['offset'])
-      self.samples = []
+      self.streaming = streaming
+      self.chunk_size = chunk_size if chunk_size else RecordFileParser.default_chunk_size
+      self.use_cache = use_cache
+      self.record_filter = record_filter
+      self.samples = empty_records()
       self.capacity = 0
       self.current = 0
       self.tick_offset = 0
+      self.first_tick = None
+      self.column_chunks = None
+      self.first_columns = None
 
-    def create_parser(self):
-      print('Parsing record file at ' + str(self.deployment_path))
+    def get_record_file(self):
       record_file = 'ModelEngineRecord.csv'
       if 'RecordFile' in self.configuration.control:
           record_file = self.configuration.control['RecordFile']
 
-      self.samples = list(csv.DictReader(open(self.deployment_path + '/' + record_file, newline='')))
+      return self.deployment_path + '/' + record_file
+
+    def synchronize_columns(self, target_tick):
+      ''' Synchronize this record to target_tick (the first tick of the
+          previous deployment's record, or 0 for none), taken from the first
+          row of the record file alone, so the tick offset is known before
+          the columns are parsed (and filtered).
+      '''
+      first_tick = read_first_tick(self.get_record_file())
+      if target_tick <= 0 or first_tick is None:
+          self.tick_offset = 0
+      else:
+          self.tick_offset = target_tick - first_tick
+
+      self.first_tick = first_tick + self.tick_offset if first_tick is not None else None
+      return self.first_tick if self.first_tick is not None else 0
+
+    def get_raw_filter(self):
+      ''' Return the record filter in terms of this record file's own
+          neuron indexes and ticks, or None if there is no filter.
+      '''
+      if self.record_filter is None:
+          return None
+      return self.record_filter.shifted(self.deployment_offset, self.tick_offset)
+
+    def create_column_reader(self, columns=None):
+      ''' Prepare to read the record columns, after synchronize_columns.
+          The record file is parsed into typed column arrays, a chunk at a
+          time when streaming, or all at once otherwise.  If the columns
+          were already parsed (and filtered) elsewhere, pass them in.
+      '''
+      if columns is not None:
+          self.column_chunks = iter([])
+          self.first_columns = columns
+      else:
+          print('Parsing record columns at ' + str(self.deployment_path))
+          chunk_size = self.chunk_size if self.streaming else None
+          self.column_chunks = iter_record_columns(self.get_record_file(), chunk_size, self.use_cache, self.get_raw_filter())
+          self.first_columns = next(self.column_chunks, None)
+
+    def create_window_reader(self, target_tick):
+      ''' Synchronize to target_tick as synchronize_columns does, but from
+          the record file's index (or sidecar) rather than a full parse.
+      '''
+      first_tick = get_first_tick(self.get_record_file(), self.use_cache)
+      if target_tick <= 0 or first_tick is None:
+          self.tick_offset = 0
+      else:
+          self.tick_offset = target_tick - first_tick
+
+      return first_tick + self.tick_offset if first_tick is not None else 0
+
+    def read_window(self, first_tick=None, end_tick=None, first_time=None, end_time=None):
+      ''' Yield the record columns within a window of synchronized ticks
+          or of times, with deployment and tick offsets applied.
+      '''
+      if first_tick is not None:
+          first_tick -= self.tick_offset
+      if end_tick is not None:
+          end_tick -= self.tick_offset
+
+      for columns in iter_record_window(self.get_record_file(), first_tick, end_tick, first_time, end_time, self.use_cache):
+          yield filter_records(offset_records(columns, self.deployment_offset, self.tick_offset), self.record_filter)
+
+    def read_columns(self):
+      ''' Yield the record columns with deployment and tick offsets applied.
+      '''
+      columns = self.first_columns
+      self.first_columns = None
+      while columns is not None:
+          yield offset_records(columns, self.deployment_offset, self.tick_offset)
+          columns = next(self.column_chunks, None)
+
+    def create_parser(self):
+      ''' Prepare to read the record a sample at a time, through at_end,
+          synchronize, next and get_current_sample.  The samples are served
+          from the record columns, a chunk of chunk_size rows at a time when
+          streaming, so only that chunk is held in memory.  Every row is
+          read; record_filter applies to the column readers alone.
+      '''
+      print('Parsing record file at ' + str(self.deployment_path))
+      chunk_size = self.chunk_size if self.streaming else None
+      self.column_chunks = iter_record_columns(self.get_record_file(), chunk_size, self.use_cache)
+      self.read_chunk()
+
+    def read_chunk(self):
+      ''' Replace the buffered samples with the next chunk of record columns.
+      '''
+      self.samples = next((columns for columns in self.column_chunks if len(columns) > 0), empty_records())
       self.current = 0
       self.capacity = len(self.samples)
 
     def at_end(self):
       return self.current >= self.capacity
-    
+
     def synchronize(self, target_tick):
-        if target_tick <= 0:
+        if target_tick <= 0 or self.at_end():
             self.tick_offset = 0
         else:
-            tick = int(self.samples[self.current]['tick'])
-            self.tick_offset = target_tick - tick
+            self.tick_offset = target_tick - int(self.samples['tick'][self.current])
 
+        self.first_tick = self.get_current_tick() if not self.at_end() else None
         return self.get_current_tick()
 
     def next(self):
         if not self.at_end():
             self.current += 1
+            if self.current >= self.capacity:
+                self.read_chunk()
 
         return self.get_current_tick()
 
     def get_current_sample(self):
         if self.at_end():
             return None
-        
-        print('Sampling record from engine ' + self.deployment_path)
-        sample = self.samples[self.current]
-        return {
-            'tick': int(sample['tick']) + self.tick_offset,
-            'Neuron-Event-Type': int(sample['Neuron-Event-Type']),
-            'Neuron-Index': int(sample['Neuron-Index']) + self.deployment_offset,
-            'Neuron-Activation': int(sample['Neuron-Activation']),
-            'Hypersensitive': int(sample['Hypersensitive']),
-            'Synapse-Index': int(sample['Synapse-Index']) if sample['Synapse-Index'] != 'N/A' else None,
-            'Synapse-Strength': int(sample['Synapse-Strength']) if sample['Synapse-Strength'] != 'N/A' else None
-        }
-    
+
+        row = offset_records(self.samples[self.current:self.current + 1], self.deployment_offset, self.tick_offset)
+        return record_sample(row, 0)
+
     def get_current_tick(self):
         current_tick = 0
         if not self.at_end():
-            current_tick = int(self.samples[self.current]['tick']) + self.tick_offset
+            current_tick = int(self.samples['tick'][self.current]) + self.tick_offset
 
         return current_tick
 
     def get_current_time(self):
         if self.at_end():
             return None
-        
-        time_stamp = self.samples[self.current]['time']
-        time_stamp_parts = time_stamp.split('.')
-
-        current_time = datetime.fromisoformat(time_stamp_parts[0])
-
-        nanoseconds = int(time_stamp_parts[-1])
-        microseconds = round(nanoseconds / 1000)
-        current_time_offset = timedelta(microseconds=microseconds)
-        current_time += current_time_offset
 
-        return current_time
+        nanoseconds = int(self.samples['time'][self.current])
+        return unix_epoch + timedelta(seconds=nanoseconds // 1000000000, microseconds=round(nanoseconds % 1000000000 / 1000))
 
 
 class Records:
-    def __init__(self, configuration):
+    def __init__(self, configuration, streaming=False, use_cache=True, processes=None, record_filter=None):
+      ''' With processes set (and not streaming), the deployments' record
+          files are parsed in parallel by a pool of that many processes.
+          A single record file is split across the pool by byte range.
+          With record_filter set (a RecordFilter), the record columns hold
+          only the rows that pass it.  first_tick is still the tick of the
+          first row of the merged record, filtered out or not.
+      '''
       self.configuration = configuration
       self.record_path = self.configuration.find_record_path()
+      self.streaming = streaming
+      self.use_cache = use_cache
+      self.processes = processes
+      self.record_filter = record_filter
+      self.first_tick = None
       self.record_file_parsers = []
+      self.merge_queue = []
 
     def create_parsers(self):
       starting_tick = 0
 
       for deployment in self.configuration.get_deployment_map():
-          parser = RecordFileParser(self.configuration, deployment)
+          parser = RecordFileParser(self.configuration, deployment, streaming=self.streaming, use_cache=self.use_cache)
           parser.create_parser()
           starting_tick = parser.synchronize(starting_tick)
           self.record_file_parsers.append(parser)
 
-    def get_next_sample(self):
-        first_tick = sys.maxsize
-        first_parser = 0
-        done = True
+      first_ticks = [parser.first_tick for parser in self.record_file_parsers if parser.first_tick is not None]
+      self.first_tick = min(first_ticks) if first_ticks else None
+      self.create_merge_queue()
+
+    def create_column_readers(self):
+      starting_tick = 0
 
+      parsers = []
+      for deployment in self.configuration.get_deployment_map():
+          parser = RecordFileParser(self.configuration, deployment, streaming=self.streaming, use_cache=self.use_cache, record_filter=self.record_filter)
+          starting_tick = parser.synchronize_columns(starting_tick)
+          parsers.append(parser)
+
+      first_ticks = [parser.first_tick for parser in parsers if parser.first_tick is not None]
+      self.first_tick = min(first_ticks) if first_ticks else None
+
+      parsed_columns = [None] * len(parsers)
+      if self.processes and not self.streaming:
+          print('Parsing ' + str(len(parsers)) + ' record files in parallel')
+          parsed_columns = load_record_files([parser.get_record_file() for parser in parsers], self.use_cache, self.processes,
+              [parser.get_raw_filter() for parser in parsers])
+
+      for parser, columns in zip(parsers, parsed_columns):
+          parser.create_column_reader(columns)
+          self.record_file_parsers.append(parser)
+
+    def iter_columns(self):
+        ''' Yield tick-ordered chunks of record columns merged across all
+            deployments.  Without streaming, this is a single chunk.
+        '''
+        self.create_column_readers()
+        return merge_record_streams([parser.read_columns() for parser in self.record_file_parsers])
+
+    def load_columns(self):
+        return merge_records(list(self.iter_columns()))
+
+    def resume_columns(self, tick_offsets, resume_tick, first_tick=None):
+        ''' Yield tick-ordered chunks of record columns as iter_columns does,
+            but only from (synchronized) resume_tick on, using the tick offset
+            found for each deployment by an earlier pass.  Each record file's
+            index is used to skip to resume_tick.
+        '''
+        self.first_tick = first_tick
+        self.record_file_parsers = []
+        for deployment, tick_offset in zip(self.configuration.get_deployment_map(), tick_offsets):
+            parser = RecordFileParser(self.configuration, deployment, use_cache=self.use_cache, record_filter=self.record_filter)
+            parser.tick_offset = tick_offset
+            self.record_file_parsers.append(parser)
+
+        return merge_record_streams([parser.read_window(first_tick=resume_tick) for parser in self.record_file_parsers])
+
+    def get_record_files(self):
+        return [RecordFileParser(self.configuration, deployment).get_record_file() for deployment in self.configuration.get_deployment_map()]
+
+    def follow(self, poll_interval=0.5, idle_timeout=30.0, stop_callback=None):
+        ''' Yield tick-ordered chunks of record columns, merged across all
+            deployments, as rows are appended to record files that are still
+            being written.  A tick is released once every record has moved
+            past it.  Following ends, flushing the remaining rows, when no
+            record grows for idle_timeout seconds or stop_callback returns True.
+        '''
+        parsers = []
+        tails = []
+        for deployment in self.configuration.get_deployment_map():
+            parser = RecordFileParser(self.configuration, deployment, record_filter=self.record_filter)
+            print('Following record file ' + parser.get_record_file())
+            parsers.append(parser)
+            tails.append(RecordTail(parser.get_record_file()))
+        self.record_file_parsers = parsers
+
+        pending = [empty_records() for parser in parsers]
+        first_ticks = [None for parser in parsers]
+        last_ticks = [None for parser in parsers]
+        idle_since = time.time()
+        try:
+            while True:
+                for index, tail in enumerate(tails):
+                    records = tail.poll()
+                    if len(records) > 0:
+                        pending[index] = np.concatenate([pending[index], records])
+                        idle_since = time.time()
+
+                # Synchronize each parser, in deployment order, once it has rows.
+                for index, parser in enumerate(parsers):
+                    if first_ticks[index] is None:
+                        target_tick = first_ticks[index - 1] if index > 0 else 0
+                        if len(pending[index]) == 0 or target_tick is None:
+                            break
+                        raw_first_tick = int(pending[index]['tick'][0])
+                        parser.tick_offset = target_tick - raw_first_tick if target_tick > 0 else 0
+                        first_ticks[index] = raw_first_tick + parser.tick_offset
+                        parser.first_tick = first_ticks[index]
+                        if self.first_tick is None or first_ticks[index] < self.first_tick:
+                            self.first_tick = first_ticks[index]
+                    if len(pending[index]) > 0:
+                        last_ticks[index] = int(pending[index]['tick'][-1]) + parser.tick_offset
+
+                stopping = (time.time() - idle_since > idle_timeout) or (stop_callback is not None and stop_callback())
+                if stopping or None not in last_ticks:
+                    limit = None if stopping else min(last_ticks)
+                    parts = []
+                    for index, parser in enumerate(parsers):
+                        if first_ticks[index] is None:
+                            continue
+                        count = len(pending[index]) if limit is None else np.searchsorted(pending[index]['tick'], limit - parser.tick_offset, side='left')
+                        parts.append(filter_records(offset_records(pending[index][:count], parser.deployment_offset, parser.tick_offset), self.record_filter))
+                        pending[index] = pending[index][count:]
+                    columns = merge_records(parts)
+                    if len(columns) > 0:
+                        yield columns
+
+                if stopping:
+                    return
+                time.sleep(poll_interval)
+        finally:
+            for tail in tails:
+                tail.close()
+
+    def query(self, first_tick=None, end_tick=None, first_time=None, end_time=None):
+        ''' Yield tick-ordered chunks of record columns, merged across all
+            deployments, for first_tick <= tick < end_tick (synchronized ticks)
+            and first_time <= time < end_time (nanoseconds).  Omitted bounds
+            are open.  Each record file is indexed once, so only the rows
+            near the window are read.
+        '''
+        starting_tick = 0
+        self.record_file_parsers = []
+        for deployment in self.configuration.get_deployment_map():
+            parser = RecordFileParser(self.configuration, deployment, use_cache=self.use_cache, record_filter=self.record_filter)
+            starting_tick = parser.create_window_reader(starting_tick)
+            self.record_file_parsers.append(parser)
+
+        return merge_record_streams([parser.read_window(first_tick, end_tick, first_time, end_time) for parser in self.record_file_parsers])
+
+    def create_merge_queue(self):
+        ''' Build a priority queue of (current tick, parser index) entries,
+            one for each parser that still has samples.  The parser index
+            breaks ties, so parsers at the same tick are drained in
+            deployment order.
+        '''
+        self.merge_queue = []
         for index, parser in enumerate(self.record_file_parsers):
             if not parser.at_end():
-                parser_current_tick = parser.get_current_tick()
-                if parser_current_tick < first_tick:
-                    first_tick = parser_current_tick
-                    first_parser = index
-                    done = False
+                self.merge_queue.append((parser.get_current_tick(), index))
+
+        heapq.heapify(self.merge_queue)
 
-        if done:
+    def get_next_sample(self):
+        ''' Return the next sample merged across the deployments' records
+            in tick order, after create_parsers, or None once all are read.
+            Samples at the same tick come in deployment order.  Each sample
+            costs O(log N) for N deployments.
+        '''
+        if not self.merge_queue:
             return None
-        
-        sample = self.record_file_parsers[first_parser].get_current_sample()
-        self.record_file_parsers[first_parser].next()
+
+        first_parser = self.merge_queue[0][1]
+        parser = self.record_file_parsers[first_parser]
+        sample = parser.get_current_sample()
+        next_tick = parser.next()
+        if parser.at_end():
+            heapq.heappop(self.merge_queue)
+        else:
+            heapq.heapreplace(self.merge_queue, (next_tick, first_parser))
+
         return sample
 
 
+def build_activation_matrix(first_tick, end_tick, ticks, columns, values, state, dtype):
+    ''' Build a (end_tick - first_tick) x len(state) matrix whose row for
+        each tick holds, per column, the last value set at or before that
+        tick, forward-filled from state.  ticks, columns and values describe
+        the events in tick order; columns index into state.
+    '''
+    row_ticks = np.arange(first_tick, end_tick)
+    matrix = np.empty((len(row_ticks), len(state)), dtype=dtype)
+    matrix[:] = state
+
+    # Group the events by column, keeping tick (and record) order within each column.
+    order = np.lexsort((ticks, columns))
+    ticks = ticks[order]
+    columns = columns[order]
+    values = values[order]
+    bounds = np.searchsorted(columns, np.arange(len(state) + 1))
+
+    for column in np.unique(columns).tolist():
+        column_ticks = ticks[bounds[column]:bounds[column + 1]]
+        column_values = values[bounds[column]:bounds[column + 1]]
+        positions = np.searchsorted(column_ticks, row_ticks, side='right') - 1
+        filled = positions >= 0
+        matrix[filled, column] = column_values[positions[filled]]
+
+    return matrix
+
+
+def iter_activation_blocks(first_tick, end_tick, ticks, columns, values, state, dtype, block_ticks):
+    ''' Yield the rows build_activation_matrix builds for ticks first_tick
+        up to end_tick as (first tick, matrix) blocks of at most block_ticks
+        rows, so the whole range is never held at once.  state is advanced
+        past each block's events once the block is built.
+    '''
+    start = 0
+    for block_tick in range(first_tick, max(end_tick, first_tick + 1), block_ticks):
+        block_end = min(block_tick + block_ticks, end_tick)
+        stop = np.searchsorted(ticks, block_end, side='left')
+        yield block_tick, build_activation_matrix(block_tick, block_end, ticks[start:stop], columns[start:stop], values[start:stop], state, dtype)
+        set_last_values(state, columns[start:stop], values[start:stop])
+        start = stop
+
+
+def slice_block(block_tick, matrix, tick_range):
+    ''' Return the first tick and a view of the rows of an output block
+        within a [first, end) tick range, or None if it has none there.
+    '''
+    first_tick, end_tick = tick_range
+    start = max(first_tick - block_tick, 0)
+    stop = min(end_tick - block_tick, len(matrix))
+    if stop <= start:
+        return None
+    return block_tick + start, matrix[start:stop]
+
+
+def set_last_values(state, columns, values):
+    ''' Set each column of state to its last value among the (column, value) events.
+    '''
+    last_positions = len(columns) - 1 - np.unique(columns[::-1], return_index=True)[1]
+    state[columns[last_positions]] = values[last_positions]
+
+
+class CleanChannel:
+    ''' A record field cleaned alongside the activation, in the same pass over
+        the record, into rows holding each column's last value at the end of
+        every tick.  The rows are written to their own run file (see
+        support.clean_run), over the same ticks as the activation rows.
+        Subclasses choose the rows and columns: get_events(cleaner, columns,
+        monitor_columns) returns a mask of the record rows that set the
+        channel, the output column each sets, and the number of output
+        columns; close(cleaner) writes the run file's header members.
+    '''
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = dtype
+        self.state = np.zeros(0, dtype=dtype)
+        self.writer = None
+        self.ticks = np.empty(0, dtype=np.int64)
+        self.columns = np.empty(0, dtype=np.int64)
+        self.values = np.empty(0, dtype=dtype)
+
+    def add_events(self, ticks, columns, values):
+        ''' Hold one chunk's (tick-ordered) events until their rows are written.
+        '''
+        self.ticks = np.concatenate([self.ticks, ticks])
+        self.columns = np.concatenate([self.columns, columns])
+        self.values = np.concatenate([self.values, values.astype(self.dtype)])
+
+    def add_rows(self, first_tick, end_tick, width, block_ticks):
+        ''' Write the rows for ticks first_tick up to end_tick from the held
+            events, in blocks of at most block_ticks rows, keeping the events
+            after end_tick for the next rows.  Columns added since the last
+            rows start at zero.
+        '''
+        self.state = np.concatenate([self.state, np.zeros(width - len(self.state), dtype=self.dtype)])
+        count = np.searchsorted(self.ticks, end_tick, side='right')
+        ticks, self.ticks = self.ticks[:count], self.ticks[count:]
+        columns, self.columns = self.columns[:count], self.columns[count:]
+        values, self.values = self.values[:count], self.values[count:]
+        if self.writer is None:
+            self.writer = CleanRunWriter(self.path)
+        for block_tick, matrix in iter_activation_blocks(first_tick, end_tick, ticks, columns, values, self.state, self.dtype, block_ticks):
+            self.writer.write_block(block_tick, matrix)
+        set_last_values(self.state, columns, values)
+
+
+class HypersensitiveChannel(CleanChannel):
+    ''' The Hypersensitive flag of each monitored neuron, in the same columns as the activation.
+    '''
+    field = 'hypersensitive'
+    event_types = [NeuronRecordType.Decay.value, NeuronRecordType.Spike.value, NeuronRecordType.Refractory.value,
+        NeuronRecordType.SynapseAdjust.value, NeuronRecordType.HyperSensitive.value]
+
+    def get_events(self, cleaner, columns, monitor_columns):
+        selected = np.isin(columns['event_type'], HypersensitiveChannel.event_types) & (monitor_columns >= 0)
+        return selected, monitor_columns[selected], len(cleaner.monitor_indices)
+
+    def close(self, cleaner):
+        if self.writer is None:
+            self.writer = CleanRunWriter(self.path)
+        self.writer.close(cleaner.outputheader, cleaner.monitor_indices)
+
+
+class SynapseStrengthChannel(CleanChannel):
+    ''' The last strength of each synapse of the monitored neurons, one column
+        per (neuron, synapse) pair, in the order the pairs first appear.
+    '''
+    field = 'synapse_strength'
+
+    def __init__(self, path, dtype):
+        CleanChannel.__init__(self, path, dtype)
+        self.header = ['time']
+        self.neuron_indices = []
+        self.synapse_indices = []
+        self.sorted_keys = np.empty(0, dtype=np.int64)
+        self.sorted_columns = np.empty(0, dtype=np.int64)
+
+    def get_events(self, cleaner, columns, monitor_columns):
+        selected = (columns['event_type'] == NeuronRecordType.SynapseAdjust.value) & (monitor_columns >= 0) & (columns['synapse_index'] != NOT_AVAILABLE)
+        neuron_indices = columns['neuron_index'][selected].astype(np.int64)
+        synapse_indices = columns['synapse_index'][selected].astype(np.int64)
+        keys = (neuron_indices << 32) | synapse_indices
+        self.add_synapses(cleaner, keys, monitor_columns[selected])
+        return selected, self.get_synapse_columns(keys), len(self.neuron_indices)
+
+    def get_synapse_columns(self, keys):
+        ''' Return the output column of each (neuron, synapse) key, or -1 for keys not seen before.
+        '''
+        synapse_columns = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.sorted_keys) > 0:
+            positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+            matched = self.sorted_keys[positions] == keys
+            synapse_columns[matched] = self.sorted_columns[positions[matched]]
+        return synapse_columns
+
+    def add_synapses(self, cleaner, keys, monitor_columns):
+        ''' Add an output column for each (neuron, synapse) key not seen before.
+        '''
+        unique_keys, first_positions = np.unique(keys, return_index=True)
+        new = self.get_synapse_columns(unique_keys) < 0
+        if not new.any():
+            return
+
+        for position in np.sort(first_positions[new]).tolist():
+            neuron_index = int(keys[position] >> 32)
+            synapse_index = int(keys[position] & 0xffffffff)
+            self.header.append(cleaner.outputheader[monitor_columns[position] + 1] + '/' + str(synapse_index))
+            self.neuron_indices.append(neuron_index)
+            self.synapse_indices.append(synapse_index)
+
+        all_keys = (np.array(self.neuron_indices, dtype=np.int64) << 32) | np.array(self.synapse_indices, dtype=np.int64)
+        self.sorted_keys, self.sorted_columns = np.unique(all_keys, return_index=True)
+
+    def close(self, cleaner):
+        if self.writer is None:
+            self.writer = CleanRunWriter(self.path)
+        self.writer.close(self.header, self.neuron_indices, self.synapse_indices)
+
+
+class ChangePoints:
+    ''' The cleaned run stored sparsely, as only the (tick, neuron, value)
+        points where a monitored neuron's activation changes.  Dense
+        rows for any subset of neurons can be expanded on demand.
+    '''
+    def __init__(self, header, neuron_indices, first_tick, end_tick, ticks, columns, values, trigger_ticks):
+        self.header = list(header)
+        self.neuron_indices = np.asarray(neuron_indices, dtype=np.int64)
+        self.first_tick = first_tick
+        self.end_tick = end_tick
+        self.ticks = ticks
+        self.columns = columns
+        self.values = values
+        self.trigger_ticks = trigger_ticks
+
+    def save(self, path):
+        np.savez_compressed(path, header=np.array(self.header), neuron_indices=self.neuron_indices,
+            tick_range=np.array([self.first_tick, self.end_tick], dtype=np.int64),
+            ticks=self.ticks, columns=self.columns, values=self.values, trigger_ticks=self.trigger_ticks)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            first_tick, end_tick = data['tick_range'].tolist()
+            return ChangePoints(data['header'].tolist(), data['neuron_indices'], first_tick, end_tick,
+                data['ticks'], data['columns'], data['values'], data['trigger_ticks'])
+
+    def expand(self, neuron_indices=None, first_tick=None, end_tick=None):
+        ''' Return the header, the row ticks and the dense activation
+            matrix for the given neurons (all monitored neurons if None)
+            over ticks first_tick up to end_tick.  Raise ValueError for a
+            neuron that is not monitored.
+        '''
+        first_tick = self.first_tick if first_tick is None else first_tick
+        end_tick = self.end_tick if end_tick is None else end_tick
+        if neuron_indices is None:
+            selected = np.arange(len(self.neuron_indices))
+        else:
+            monitor_columns = { index: column for column, index in enumerate(self.neuron_indices.tolist()) }
+            unknown = [index for index in neuron_indices if index not in monitor_columns]
+            if unknown:
+                raise ValueError('Neuron index ' + str(unknown[0]) + ' is not monitored in this run')
+            selected = np.array([monitor_columns[index] for index in neuron_indices], dtype=np.int64)
+
+        # Map the selected columns onto 0..len(selected)-1, dropping the rest.
+        remap = np.full(len(self.neuron_indices), -1, dtype=np.int64)
+        remap[selected] = np.arange(len(selected))
+        columns = remap[self.columns]
+        kept = (columns >= 0) & (self.ticks < end_tick)
+        ticks = self.ticks[kept]
+        columns = columns[kept]
+        values = self.values[kept]
+
+        # Changes before first_tick only set the starting state.
+        state = np.zeros(len(selected), dtype=self.values.dtype)
+        earlier = ticks < first_tick
+        state[columns[earlier]] = values[earlier]
+        later = ~earlier
+        matrix = build_activation_matrix(first_tick, end_tick, ticks[later], columns[later], values[later], state, self.values.dtype)
+
+        header = [self.header[0]] + [self.header[column + 1] for column in selected.tolist()]
+        return header, np.arange(first_tick, end_tick), matrix
+
+
+class TriggerSpec:
+    ''' A declarative epoch trigger, the vectorized alternative to a trigger
+        callback: a sample of one of event_types (NeuronRecordType values)
+        for one of neurons (indexes, or range objects of indexes) fires it.
+        Omitted criteria match every sample.  With tick_stride, only the
+        first trigger in each tick_stride-aligned window of ticks fires;
+        with min_gap, a trigger less than min_gap ticks after the last one
+        fired is ignored.
+    '''
+    def __init__(self, event_types=None, neurons=None, tick_stride=None, min_gap=None):
+        self.event_types = event_types
+        self.neurons = neurons
+        self.tick_stride = tick_stride
+        self.min_gap = min_gap
+        self.sample_filter = RecordFilter(event_types=event_types, neurons=neurons)
+
+    def get_trigger_ticks(self, ticks, event_types, neuron_indices, last_trigger_tick=None):
+        ''' Return the sorted ticks at which triggers fire among the samples
+            with these (tick-ordered) ticks, event types and neuron indexes,
+            given the tick of the last trigger fired before them, if any.
+        '''
+        trigger_ticks = np.unique(ticks[self.sample_filter.mask(ticks, event_types, neuron_indices)])
+        if self.tick_stride:
+            windows = trigger_ticks // self.tick_stride
+            trigger_ticks = trigger_ticks[np.unique(windows, return_index=True)[1]]
+            if last_trigger_tick is not None:
+                trigger_ticks = trigger_ticks[trigger_ticks // self.tick_stride != last_trigger_tick // self.tick_stride]
+        if self.min_gap:
+            if last_trigger_tick is not None:
+                trigger_ticks = trigger_ticks[trigger_ticks >= last_trigger_tick + self.min_gap]
+            # Each fired trigger suppresses the rest within min_gap; step from one fired trigger to the next.
+            next_positions = np.searchsorted(trigger_ticks, trigger_ticks + self.min_gap, side='left')
+            fired = []
+            position = 0
+            while position < len(trigger_ticks):
+                fired.append(position)
+                position = int(next_positions[position])
+            trigger_ticks = trigger_ticks[fired]
+
+        return trigger_ticks
+
 
 class Cleaner:
-    def __init__(self, configuration, monitor_neurons = None, trigger_callback=None):
+    cleaned_types = [NeuronRecordType.Decay.value, NeuronRecordType.Spike.value, NeuronRecordType.Refractory.value, NeuronRecordType.SynapseAdjust.value]
+    channel_types = { 'hypersensitive': HypersensitiveChannel, 'synapse_strength': SynapseStrengthChannel }
+    block_ticks = 10000
+
+    def __init__(self, configuration, monitor_neurons = None, trigger_callback=None, streaming=False, dtype=np.int32, sparse=False, processes=None, export_csv=False, epoch_writers=2, export_epoch_tensor=False, epoch_length=None, channels=()):
         ''' Create the header for the cleaned CSV file, with the neuron's
             name and numeric ID for column head.  Clean the output row
             to contain the correct number of int values in preparation.
             monitor_neurons should be an array of objects like { name: "JenniferAniston", index: 42 }
+            trigger_callback is either a TriggerSpec, or a callable that is
+            passed each cleaned sample and returns True where an epoch starts.
+            Set streaming to read the record files lazily rather than whole.
+            dtype is the type of the cleaned activation values.
+            Set sparse to keep only activation change points (see ChangePoints)
+            rather than dense rows and epoch files.
+            Without monitor_neurons, every neuron in the record is monitored,
+            discovered during the same pass over the record that cleans it.
+            Set processes to parse the deployments' record files in parallel.
+            The cleaned run is written in columnar form (see support.clean_run)
+            as it is cleaned, in blocks of at most block_ticks rows, so only
+            the current block and epoch are held in memory, streaming or not
+            (though without streaming the record columns themselves are read
+            whole); set export_csv to also write it as CSV, once it is complete.
+            Epoch files are written by a pool of epoch_writers threads, and
+            listed in the run's epoch manifest (see write_epoch_manifest).
+            Set export_epoch_tensor to also write all the epochs as a single
+            array of epoch_length ticks each (see write_epoch_tensor); it
+            needs dense output, so ValueError is raised if sparse is set.
+            channels names further record fields to clean in the same pass,
+            each written to the clean output file with its extension replaced
+            by '.<channel>.npz': 'hypersensitive' (the flag of each monitored
+            neuron) and 'synapse_strength' (the strength of each of their
+            synapses).  Channels are cleaned in dense mode only, so
+            ValueError is raised if they are given with sparse set.
         '''
+        if export_epoch_tensor and sparse:
+            raise ValueError('An epoch tensor can only be exported from dense output, not sparse')
+        if channels and sparse:
+            raise ValueError('Channels can only be cleaned to dense output, not sparse')
+
         self.configuration = configuration
+        self.export_csv = export_csv
+        self.streaming = streaming
+        self.processes = processes
+        self.dtype = dtype
+        self.sparse = sparse
         self.monitor_neurons = monitor_neurons
         self.is_trigger = trigger_callback
         self.outputheader = []
-        self.outputrow = []
 
         self.outputheader.append('time')
-        self.outputrow.append(0)
-        self.output = []
+        self.run_writer = None
         self.epochoutput = []
-        self.trigger = None
+        self.last_tick = None
+        self.first_tick = None
+        self.change_points = []
+        self.trigger_ticks = []
+        self.last_trigger_tick = None
+        self.next_epoch_number = None
+        self.checkpointing = False
+        self.unsaved_output = []
+        self.checkpoint_block_ticks = []
+        self.checkpoint_change_points = 0
+        self.deferred_epochs = []
+        self.epoch_callback = None
+        self.epoch_writers = epoch_writers
+        self.epoch_pool = None
+        self.epoch_writes = deque()
+        self.epoch_manifest = []
+        self.epoch_trigger_tick = None
+        self.export_epoch_tensor = export_epoch_tensor
+        self.epoch_length = epoch_length
+        self.channels = []
+        for channel in channels:
+            channel_path = os.path.splitext(self.get_clean_record_path())[0] + '.' + channel + '.npz'
+            channel_dtype = np.int8 if channel == 'hypersensitive' else self.dtype
+            self.channels.append(Cleaner.channel_types[channel](channel_path, channel_dtype))
 
-        if not self.monitor_neurons:
-            self.monitor_neurons = self.generate_monitor_neurons()
+        self.discover_monitors = not self.monitor_neurons
+        if self.discover_monitors:
+            self.monitor_neurons = []
 
         self.monitor_indices = []
         self.first_sample = []
+        self.state = np.zeros(0, dtype=self.dtype)
+        self.add_monitor_neurons(self.monitor_neurons)
 
-        for neuron in self.monitor_neurons:
+    def add_monitor_neurons(self, monitor_neurons):
+        ''' Add output columns for the monitor neurons, and rebuild the
+            lookup of each neuron index's output column (-1 for neurons
+            not monitored).  New neurons start with zero activation.
+        '''
+        for neuron in monitor_neurons:
             name = neuron[0] + '(' + str(neuron[1]) + ')'
             self.outputheader.append(name)
-            self.outputrow.append(0)
             self.monitor_indices.append(neuron[1])
             self.first_sample.append(0)
 
-        self.output.append(copy.copy(self.outputheader))
-        self.output.append(copy.copy(self.first_sample))
-        self.reset_epoch_output()
+        self.state = np.concatenate([self.state, np.zeros(len(self.monitor_indices) - len(self.state), dtype=self.dtype)])
+
+        sorted_monitor_indices, monitor_columns = np.unique(np.array(self.monitor_indices, dtype=np.int64), return_index=True)
+        lookup_size = int(sorted_monitor_indices[-1]) + 1 if len(sorted_monitor_indices) > 0 else 0
+        self.monitor_lookup = np.full(lookup_size, -1, dtype=np.int64)
+        self.monitor_lookup[sorted_monitor_indices] = monitor_columns
+
+    def discover_monitor_neurons(self, neuron_indices):
+        ''' Monitor every neuron in this chunk not already monitored, in the
+            order each first appears.  Generate a name for each.
+        '''
+        unique_indices, first_positions = np.unique(neuron_indices, return_index=True)
+        new = self.get_monitor_columns(unique_indices) < 0
+        if not new.any():
+            return
+
+        new_indices = unique_indices[new][np.argsort(first_positions[new])]
+        monitor_neurons = []
+        for monitor_index in new_indices.tolist():
+            monitor_neurons.append(['Neuron'+str(monitor_index), monitor_index])
+
+        self.monitor_neurons.extend(monitor_neurons)
+        self.add_monitor_neurons(monitor_neurons)
+
+    def get_record_filter(self):
+        ''' Return a filter for just the record rows the cleaner uses: the
+            cleaned event types, for the monitored neurons.  A trigger callback
+            may look at any neuron, and discovery at any row, so neither
+            narrows by neuron; discovery gets no filter at all.  A TriggerSpec
+            adds its own neurons, and the hypersensitive channel its events.
+        '''
+        if self.discover_monitors:
+            return None
+
+        neurons = self.monitor_indices
+        if isinstance(self.is_trigger, TriggerSpec):
+            neurons = None if self.is_trigger.neurons is None else list(self.monitor_indices) + list(self.is_trigger.neurons)
+        elif self.is_trigger:
+            neurons = None
+        event_types = set(Cleaner.cleaned_types)
+        for channel in self.channels:
+            if isinstance(channel, HypersensitiveChannel):
+                event_types.update(HypersensitiveChannel.event_types)
+        return RecordFilter(event_types=sorted(event_types), neurons=neurons)
 
-    def clean_data(self):
-        last_tick = 0
-        last_row = []
-
-        records = Records(self.configuration)
-        records.create_parsers()
-
-        sample = records.get_next_sample()
-        last_tick = sample['tick']
-        while sample is not None:
-            event_type = sample['Neuron-Event-Type']
-            if event_type == NeuronRecordType.Decay.value or event_type == NeuronRecordType.Spike.value or event_type == NeuronRecordType.Refractory.value or event_type == NeuronRecordType.SynapseAdjust.value:
-                active_neuron = sample['Neuron-Index']
-                if active_neuron in self.monitor_indices:
-                    tick = sample['tick']
-                    last_row = copy.copy(self.outputrow)
-                    if last_tick != 0 and tick != last_tick:
-                        self.fill_output(last_row, last_tick, tick)
-                    self.outputrow[self.monitor_indices.index(active_neuron) + 1] = sample['Neuron-Activation']
-                    last_tick = tick
-
-                if self.is_trigger:
-                    if self.is_trigger(sample):
-                        print('Trigger sample found')
-                        tick = sample['tick']
-                        if last_tick != 0 and tick != last_tick:
-                            self.fill_output(last_row, last_tick, tick)
-                        self.write_cleaned_epoch()
-                        last_tick = tick
-
-            sample = records.get_next_sample()
+    def clean_data(self, checkpoint_interval=None):
+        ''' Clean the whole record and write the results.
+            With checkpoint_interval (seconds), the record is cleaned a chunk
+            at a time, as when streaming, and progress is checkpointed about
+            that often (see save_checkpoint).  If an earlier checkpointed
+            clean of the same record was interrupted, it is resumed from its
+            last checkpoint.  The checkpoint is removed once the run is written.
+            Channels are not checkpointed, so ValueError is raised if a
+            checkpoint_interval is given with channels.
+        '''
+        if checkpoint_interval is not None and self.channels:
+            raise ValueError('Channels cannot be checkpointed; clean without checkpoint_interval')
+        self.checkpointing = checkpoint_interval is not None
+        if checkpoint_interval is None:
+            records = Records(self.configuration, streaming=self.streaming, processes=self.processes, record_filter=self.get_record_filter())
+            chunks = records.iter_columns()
+        else:
+            records = Records(self.configuration, streaming=True, record_filter=self.get_record_filter())
+            chunks = self.resume_checkpoint(records)
+
+        last_checkpoint = time.time()
+        for columns in chunks:
+            if self.last_tick is None:
+                self.last_tick = records.first_tick
+            self.clean_columns(columns)
+            if checkpoint_interval is not None and len(columns) > 0 and time.time() - last_checkpoint >= checkpoint_interval:
+                self.save_checkpoint(records, int(columns['tick'][-1]) + 1)
+                last_checkpoint = time.time()
 
+        self.finish_run()
+        if checkpoint_interval is not None:
+            shutil.rmtree(self.get_checkpoint_path(), ignore_errors=True)
+
+    def finish_run(self):
+        ''' Write the last epoch and everything written once per run.
+        '''
         self.write_cleaned_epoch()
         self.write_cleaned_run()
+        self.write_deferred_epochs()
+        self.write_epoch_manifest()
+        self.write_epoch_tensor()
+
+    def get_clean_record_path(self):
+        record_path = self.configuration.find_record_path()
+        clean_record_file = self.configuration.control['CleanRecordFile']
+        return record_path + '/' + clean_record_file
+
+    def get_run_path(self):
+        return os.path.splitext(self.get_clean_record_path())[0] + '.npz'
 
-    def generate_monitor_neurons(self):
-        ''' Iterate through the whole CSV file, and collect all unique
-            neuron indexes.  Generate names for each neuron, and create
-            monitor_neurons as an array of objects like { name: "JenniferAniston", index: 42 }
+    def get_checkpoint_path(self):
+        return os.path.splitext(self.get_clean_record_path())[0] + '.checkpoint'
+
+    def get_run_writer(self):
+        ''' Return the writer of the run file, opening it on first use.
         '''
-        monitor_indices = []
+        if self.run_writer is None:
+            self.run_writer = CleanRunWriter(self.get_run_path())
+        return self.run_writer
 
-        records = Records(self.configuration)
-        records.create_parsers()
-        while True:
-            sample = records.get_next_sample()
-            if sample is None:
-                break
+    def get_record_keys(self, records):
+        keys = []
+        for record_file in records.get_record_files():
+            stat = os.stat(record_file)
+            keys.append({ 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns })
+        return keys
 
-            if sample['Neuron-Index'] not in monitor_indices:
-                monitor_indices.append(sample['Neuron-Index'])
+    def save_checkpoint(self, records, resume_tick):
+        ''' Save the cleaning progress to the checkpoint directory: the run
+            output blocks and change points produced since the last checkpoint,
+            then checkpoint.json, holding everything else needed to resume
+            from resume_tick (the tick offsets, neuron state, epoch counter
+            and the tick ranges of unwritten epochs).  checkpoint.json is
+            replaced atomically, so an interrupted save leaves the previous
+            checkpoint intact.
+        '''
+        checkpoint_path = self.get_checkpoint_path()
+        print('Checkpointing clean at tick ' + str(resume_tick))
+        self.wait_for_epoch_writes()    # Epochs counted by the checkpoint must be on disk.
+        os.makedirs(checkpoint_path, exist_ok=True)
+        for block_tick, matrix in self.unsaved_output:
+            np.save(checkpoint_path + '/block' + str(len(self.checkpoint_block_ticks)) + '.npy', matrix)
+            self.checkpoint_block_ticks.append(int(block_tick))
+        self.unsaved_output = []
+        for part in range(self.checkpoint_change_points, len(self.change_points)):
+            ticks, columns, values = self.change_points[part]
+            np.savez(checkpoint_path + '/change_points' + str(part) + '.npz', ticks=ticks, columns=columns, values=values)
+        self.checkpoint_change_points = len(self.change_points)
 
-        monitor_neurons = []
-        for monitor_index in monitor_indices:
-            monitor_neurons.append(['Neuron'+str(monitor_index), monitor_index])
+        checkpoint = {
+            'records': self.get_record_keys(records),
+            'tick_offsets': [int(parser.tick_offset) for parser in records.record_file_parsers],
+            'first_record_tick': records.first_tick,
+            'resume_tick': resume_tick,
+            'monitor_neurons': [[neuron[0], int(neuron[1])] for neuron in self.monitor_neurons],
+            'first_tick': self.first_tick,
+            'last_tick': self.last_tick,
+            'state': self.state.tolist(),
+            'block_ticks': self.checkpoint_block_ticks,
+            'change_point_count': len(self.change_points),
+            'trigger_ticks': [int(tick) for tick in self.trigger_ticks],
+            'last_trigger_tick': self.last_trigger_tick,
+            'next_epoch_number': self.next_epoch_number,
+            'epoch_manifest': self.epoch_manifest,
+            'epoch_trigger_tick': self.epoch_trigger_tick,
+            'epoch': self.get_epoch_range(self.epochoutput),
+            'deferred_epochs': self.deferred_epochs
+        }
+        with open(checkpoint_path + '/checkpoint.json.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_path + '/checkpoint.json.tmp', checkpoint_path + '/checkpoint.json')
+
+    def resume_checkpoint(self, records):
+        ''' Restore the cleaning progress from the checkpoint, if there is
+            one for the current record files and monitor neurons, and return
+            the record columns still to be cleaned.  Otherwise return them all.
+        '''
+        checkpoint_path = self.get_checkpoint_path()
+        try:
+            with open(checkpoint_path + '/checkpoint.json') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return self.start_checkpoint(records)
+
+        monitor_neurons = [[neuron[0], int(neuron[1])] for neuron in self.monitor_neurons]
+        if checkpoint['records'] != self.get_record_keys(records) or checkpoint['monitor_neurons'][:len(monitor_neurons)] != monitor_neurons:
+            print("Ignoring checkpoint '" + checkpoint_path + "' of a different record")
+            return self.start_checkpoint(records)
+
+        print('Resuming clean from tick ' + str(checkpoint['resume_tick']))
+        discovered = checkpoint['monitor_neurons'][len(monitor_neurons):]
+        self.monitor_neurons.extend(discovered)
+        self.add_monitor_neurons(discovered)
+        self.state = np.array(checkpoint['state'], dtype=self.dtype)
+        self.first_tick = checkpoint['first_tick']
+        self.last_tick = checkpoint['last_tick']
+        # The run file is rewritten from the saved blocks, keeping just the current epoch's rows in memory.
+        self.checkpoint_block_ticks = checkpoint['block_ticks']
+        self.epochoutput = []
+        for block, block_tick in enumerate(self.checkpoint_block_ticks):
+            matrix = np.load(checkpoint_path + '/block' + str(block) + '.npy')
+            self.get_run_writer().write_block(block_tick, matrix)
+            rows = slice_block(block_tick, matrix, checkpoint['epoch']) if checkpoint['epoch'] is not None else None
+            if rows is not None:
+                self.epochoutput.append(rows)
+        self.change_points = []
+        for part in range(checkpoint['change_point_count']):
+            with np.load(checkpoint_path + '/change_points' + str(part) + '.npz') as data:
+                self.change_points.append((data['ticks'], data['columns'], data['values']))
+        self.trigger_ticks = checkpoint['trigger_ticks']
+        self.last_trigger_tick = checkpoint['last_trigger_tick']
+        self.next_epoch_number = checkpoint['next_epoch_number']
+        self.epoch_manifest = checkpoint['epoch_manifest']
+        self.epoch_trigger_tick = checkpoint['epoch_trigger_tick']
+        self.deferred_epochs = checkpoint['deferred_epochs']
+        self.checkpoint_change_points = len(self.change_points)
+
+        return records.resume_columns(checkpoint['tick_offsets'], checkpoint['resume_tick'], checkpoint['first_record_tick'])
+
+    def start_checkpoint(self, records):
+        ''' Start a checkpointed clean of all the record columns.  The first
+            checkpoint is saved at once, fixing the epoch numbering, so that
+            a clean interrupted before its next checkpoint is not renumbered.
+        '''
+        shutil.rmtree(self.get_checkpoint_path(), ignore_errors=True)
+        chunks = records.iter_columns()
+        self.next_epoch_number = self.get_next_epoch_number(Path(self.configuration.find_record_path()))
+        if records.first_tick is not None:
+            self.save_checkpoint(records, records.first_tick)
+        return chunks
+
+    def get_epoch_range(self, blocks):
+        ''' Return the [first, end) tick range covered by epoch output blocks, or None if there are none.
+        '''
+        if not blocks:
+            return None
+        return [int(blocks[0][0]), int(blocks[-1][0]) + len(blocks[-1][1])]
+
+
+    def follow_data(self, poll_interval=0.5, idle_timeout=30.0, stop_callback=None, epoch_callback=None):
+        ''' Clean the record while the engines are still writing it, calling
+            the trigger callback and writing each epoch as soon as its rows
+            arrive (see Records.follow).  epoch_callback, if given, is called
+            with the path of each epoch file once written.  Epochs are only
+            written incrementally when monitor_neurons were given; otherwise
+            they wait until every neuron has been seen, at the end.
+        '''
+        self.epoch_callback = epoch_callback
+        records = Records(self.configuration, record_filter=self.get_record_filter())
+        for columns in records.follow(poll_interval, idle_timeout, stop_callback):
+            if self.last_tick is None:
+                self.last_tick = records.first_tick
+            self.clean_columns(columns)
+
+        self.finish_run()
+
+    def clean_columns(self, columns):
+        ''' Extend the run and epoch output through the ticks covered by
+            one tick-ordered chunk of record columns.  Each output row holds
+            the activation of every monitored neuron at the end of its tick.
+            The run starts at last_tick if set, else at the chunk's first tick.
+            Each channel's rows are extended through the same ticks.
+        '''
+        if len(columns) == 0:
+            return
+
+        ticks = columns['tick']
+        if self.last_tick is None:
+            self.last_tick = int(ticks[0])
+
+        if self.discover_monitors:
+            self.discover_monitor_neurons(columns['neuron_index'])
+
+        cleaned = np.isin(columns['event_type'], Cleaner.cleaned_types)
+        monitor_columns = self.get_monitor_columns(columns['neuron_index'])
+        active = cleaned & (monitor_columns >= 0)
+        triggers = self.find_triggers(columns, cleaned)
+
+        channel_widths = []
+        for channel in self.channels:
+            selected, channel_columns, width = channel.get_events(self, columns, monitor_columns)
+            channel.add_events(ticks[selected], channel_columns, columns[channel.field][selected])
+            channel_widths.append(width)
+
+        boundary_ticks = ticks[active | triggers]
+        if self.last_tick == 0:
+            boundary_ticks = boundary_ticks[boundary_ticks != 0]
+            if len(boundary_ticks) > 0:
+                self.last_tick = int(boundary_ticks[0])
+        if len(boundary_ticks) == 0:
+            return
+
+        first_tick = self.last_tick
+        end_tick = int(boundary_ticks[-1])
+        if self.first_tick is None:
+            self.first_tick = first_tick
+        active_ticks = ticks[active]
+        active_columns = monitor_columns[active]
+        active_values = columns['activation'][active].astype(self.dtype)
+
+        if self.sparse:
+            self.add_change_points(active_ticks, active_columns, active_values)
+            self.trigger_ticks.extend(np.unique(ticks[triggers]).tolist())
+        else:
+            trigger_ticks = np.unique(ticks[triggers])
+            for block_tick, matrix in iter_activation_blocks(first_tick, end_tick, active_ticks, active_columns, active_values, self.state, self.dtype, Cleaner.block_ticks):
+                # Each block takes the triggers before its end; the last takes the rest.
+                count = np.searchsorted(trigger_ticks, block_tick + len(matrix), side='left') if block_tick + len(matrix) < end_tick else len(trigger_ticks)
+                self.add_output(block_tick, matrix, trigger_ticks[:count].tolist())
+                trigger_ticks = trigger_ticks[count:]
+            for channel, width in zip(self.channels, channel_widths):
+                channel.add_rows(first_tick, end_tick, width, Cleaner.block_ticks)
+
+        # The state carried into the next chunk is the last activation of each neuron.
+        set_last_values(self.state, active_columns, active_values)
+        self.last_tick = end_tick
+
+    def add_output(self, first_tick, matrix, trigger_ticks):
+        ''' Write the matrix rows to the run file, and append them to the
+            epoch output, writing an epoch at each trigger tick.
+        '''
+        self.get_run_writer().write_block(first_tick, matrix)
+        if self.checkpointing:
+            self.unsaved_output.append((first_tick, matrix))
+        row = 0
+        for trigger_tick in trigger_ticks:
+            print('Trigger sample found')
+            split = min(max(trigger_tick - first_tick, row), len(matrix))
+            if split > row:
+                self.epochoutput.append((first_tick + row, matrix[row:split]))
+            self.write_cleaned_epoch()
+            self.epoch_trigger_tick = trigger_tick
+            row = split
 
-        return monitor_neurons
+        if row < len(matrix):
+            self.epochoutput.append((first_tick + row, matrix[row:]))
 
+    def add_change_points(self, ticks, columns, values):
+        ''' Keep the last value of each neuron at each tick, when it differs
+            from that neuron's value at its previous tick.
+        '''
+        order = np.lexsort((ticks, columns))
+        ticks = ticks[order]
+        columns = columns[order]
+        values = values[order]
+
+        # The last event for each (neuron, tick) is where the next one differs.
+        last = np.ones(len(ticks), dtype=bool)
+        last[:-1] = (columns[1:] != columns[:-1]) | (ticks[1:] != ticks[:-1])
+        ticks = ticks[last]
+        columns = columns[last]
+        values = values[last]
+
+        previous = np.empty_like(values)
+        if len(values) > 0:
+            previous[1:] = values[:-1]
+            first_of_column = np.ones(len(values), dtype=bool)
+            first_of_column[1:] = columns[1:] != columns[:-1]
+            previous[first_of_column] = self.state[columns[first_of_column]]
+
+        changed = values != previous
+        self.change_points.append((ticks[changed], columns[changed], values[changed]))
+
+    def get_change_points(self):
+        ''' Return the change points gathered so far, in tick order.
+        '''
+        ticks = np.concatenate([part[0] for part in self.change_points] + [np.empty(0, dtype=np.int64)])
+        columns = np.concatenate([part[1] for part in self.change_points] + [np.empty(0, dtype=np.int64)])
+        values = np.concatenate([part[2] for part in self.change_points] + [np.empty(0, dtype=self.dtype)])
+        order = np.argsort(ticks, kind='stable')
+        first_tick = self.first_tick if self.first_tick is not None else 0
+        end_tick = self.last_tick if self.last_tick is not None else 0
+        return ChangePoints(self.outputheader, self.monitor_indices, first_tick, end_tick,
+            ticks[order], columns[order], values[order], np.array(self.trigger_ticks, dtype=np.int64))
 
-    def fill_output(self, row, first_tick, last_tick):
-        ''' Extend a straigt-line value from first_tick through last_tick,
-            ensuring that the cleaned output file has a value for all ticks.
+    def get_monitor_columns(self, neuron_indices):
+        ''' Return the output column of each neuron index, or -1 for
+            neurons that are not monitored.
         '''
-        tick = first_tick
-        row[0] = tick
-        self.output.append(copy.copy(row))
-        self.epochoutput.append(copy.copy(row))
+        in_range = (neuron_indices >= 0) & (neuron_indices < len(self.monitor_lookup))
+        monitor_columns = np.full(len(neuron_indices), -1, dtype=np.int64)
+        monitor_columns[in_range] = self.monitor_lookup[neuron_indices[in_range]]
+        return monitor_columns
 
-        tick += 1
-        while tick < last_tick:
-            row[0] = tick
-            self.output.append(copy.copy(row))
-            self.epochoutput.append(copy.copy(row))
-            tick += 1
+    def find_triggers(self, columns, cleaned):
+        ''' Return a mask of the cleaned samples that fire a trigger.
+            A TriggerSpec is evaluated over the whole chunk at once; a
+            trigger callback is called for each cleaned sample.
+        '''
+        triggers = np.zeros(len(columns), dtype=bool)
+        if isinstance(self.is_trigger, TriggerSpec):
+            cleaned_columns = columns[cleaned]
+            trigger_ticks = self.is_trigger.get_trigger_ticks(cleaned_columns['tick'], cleaned_columns['event_type'],
+                cleaned_columns['neuron_index'], self.last_trigger_tick)
+            triggers[np.flatnonzero(cleaned)[np.isin(cleaned_columns['tick'], trigger_ticks)]] = True
+            if len(trigger_ticks) > 0:
+                self.last_trigger_tick = int(trigger_ticks[-1])
+        elif self.is_trigger:
+            for position in np.flatnonzero(cleaned).tolist():
+                if self.is_trigger(record_sample(columns, position)):
+                    triggers[position] = True
+
+        return triggers
+
+    def write_output_rows(self, clean_data, blocks, first_tick=None, width=None):
+        ''' Write the (tick, matrix) blocks as CSV rows of tick and activations.
+            If first_tick is given, the ticks are renumbered from it.
+            Blocks built before later neurons were discovered are padded
+            with their zero activations, to width columns (default: every
+            monitored neuron).
+        '''
+        width = len(self.monitor_indices) if width is None else width
+        for block_tick, matrix in blocks:
+            if first_tick is not None:
+                block_tick = first_tick
+                first_tick += len(matrix)
+            if matrix.shape[1] < width:
+                matrix = np.hstack((matrix, np.zeros((len(matrix), width - matrix.shape[1]), dtype=matrix.dtype)))
+            ticks = np.arange(block_tick, block_tick + len(matrix)).reshape(-1, 1)
+            np.savetxt(clean_data, np.hstack((ticks, matrix)), fmt='%d', delimiter=',', newline='\r\n')
 
     def write_cleaned_run(self):
-        ''' Write the cleaned data for the entire run to the configured clean output file.
+        ''' Finish the cleaned data for the entire run in the configured clean output file,
+            with its extension replaced by '.npz', and also write it as CSV if export_csv is set,
+            a block at a time from the '.npz'.
+            In sparse mode, the change points are written instead, as '.sparse.npz'.
         '''
-        record_path = self.configuration.find_record_path()
-        clean_record_file = self.configuration.control['CleanRecordFile']
-        record_path = record_path + '/' + clean_record_file
-        print("Writing clean record file '" + record_path + "'")
-        with open(record_path, mode='w') as clean_data:
-            data_writer = csv.writer(clean_data, delimiter=',', quoting=csv.QUOTE_NONE)
-            data_writer.writerows(self.output)
+        record_path = self.get_clean_record_path()
+        if self.sparse:
+            sparse_path = os.path.splitext(record_path)[0] + '.sparse.npz'
+            print("Writing sparse clean record file '" + sparse_path + "'")
+            self.get_change_points().save(sparse_path)
+            return
+
+        columnar_path = self.get_run_path()
+        print("Writing clean record file '" + columnar_path + "'")
+        self.get_run_writer().close(self.outputheader, self.monitor_indices)
+        self.run_writer = None
+        for channel in self.channels:
+            print("Writing clean record file '" + channel.path + "'")
+            channel.close(self)
+
+        if self.export_csv:
+            print("Writing clean record file '" + record_path + "'")
+            with open(record_path, mode='w') as clean_data:
+                data_writer = csv.writer(clean_data, delimiter=',', quoting=csv.QUOTE_NONE)
+                data_writer.writerow(self.outputheader)
+                data_writer.writerow(self.first_sample)
+                for block in iter_clean_run(columnar_path):
+                    self.write_output_rows(clean_data, [block])
 
     def write_cleaned_epoch(self):
         ''' Write the cleaned epoch data to the configured clean output file.
             Note this may be called when the first epoch starts, so skip that one.
+            Epochs are numbered on from the existing epoch files when the first is
+            written, then counted, so a resumed run rewrites the same epoch files.
+            While monitor neurons are still being discovered, just the epoch's
+            tick range (and trigger tick) is kept, and the epoch is written from
+            the run file at the end of the run, so every epoch has the same columns.
+            The file itself is written in the background (see queue_epoch_write).
         '''
-        if len(self.epochoutput) > 2:
-            for i in range(1, len(self.epochoutput)):
-                self.epochoutput[i][0] = i           # Tick starts with 1 for all epochs.
+        if self.epochoutput and self.discover_monitors:
+            self.deferred_epochs.append(self.get_epoch_range(self.epochoutput) + [self.epoch_trigger_tick])
+        elif self.epochoutput:
             record_path = self.configuration.find_record_path()
-            epoch_number = self.get_next_epoch_number(Path(record_path))
+            if self.next_epoch_number is None:
+                self.next_epoch_number = self.get_next_epoch_number(Path(record_path))
+            epoch_number = self.next_epoch_number
+            self.next_epoch_number += 1
             record_path = record_path.rstrip('/') + '/' + "epoch" + str(epoch_number) + ".csv"
+            first_tick, end_tick = self.get_epoch_range(self.epochoutput)
+            self.epoch_manifest.append({ 'epoch': epoch_number, 'first_tick': first_tick, 'end_tick': end_tick,
+                'trigger_tick': self.epoch_trigger_tick, 'path': record_path })
             print("Writing clean epoch file '" + record_path + "'")
-            with open(record_path, mode='w') as clean_data:
-                data_writer = csv.writer(clean_data, delimiter=',', quoting=csv.QUOTE_NONE)
-                data_writer.writerows(self.epochoutput)
+            self.queue_epoch_write(record_path, self.epochoutput)
 
         self.reset_epoch_output()
 
+    def write_epoch_file(self, record_path, header, first_row, blocks, width):
+        with open(record_path + '.tmp', mode='w') as clean_data:
+            data_writer = csv.writer(clean_data, delimiter=',', quoting=csv.QUOTE_NONE)
+            data_writer.writerow(header)
+            data_writer.writerow(first_row)
+            self.write_output_rows(clean_data, blocks, 2, width)
+        os.replace(record_path + '.tmp', record_path)      # Never leave a partly written epoch file.
+
+    def queue_epoch_write(self, record_path, blocks):
+        ''' Hand the epoch file to the writer pool.  The epoch's blocks are
+            never modified once built, so the pool may read them while
+            cleaning continues.  Cleaning only waits when more than two
+            epochs per writer are queued, bounding the epochs held in memory.
+        '''
+        if self.epoch_pool is None:
+            self.epoch_pool = ThreadPoolExecutor(max_workers=self.epoch_writers)
+
+        first_row = [1] + self.first_sample[1:]     # Tick starts with 1 for all epochs.
+        future = self.epoch_pool.submit(self.write_epoch_file, record_path, list(self.outputheader), first_row, blocks, len(self.monitor_indices))
+        self.epoch_writes.append((future, record_path))
+        while self.epoch_writes and (self.epoch_writes[0][0].done() or len(self.epoch_writes) > 2 * self.epoch_writers):
+            self.finish_epoch_write()
+
+    def finish_epoch_write(self):
+        ''' Wait for the oldest queued epoch file, raising any error writing
+            it, and pass it to the epoch callback.  Epochs are finished in
+            order, on the cleaning thread.
+        '''
+        future, record_path = self.epoch_writes.popleft()
+        future.result()
+        if self.epoch_callback:
+            self.epoch_callback(record_path)
+
+    def wait_for_epoch_writes(self):
+        while self.epoch_writes:
+            self.finish_epoch_write()
+
+    def write_epoch_manifest(self):
+        ''' Wait for the queued epoch files, then write the run's epoch manifest
+            next to the configured clean output file, with its extension replaced
+            by '.epochs.json'.  It lists each epoch's number, [first_tick, end_tick)
+            range in run ticks, the tick of the trigger that started it (None for
+            the first) and the path of its file.
+        '''
+        self.wait_for_epoch_writes()
+        if self.epoch_pool is not None:
+            self.epoch_pool.shutdown()
+            self.epoch_pool = None
+
+        manifest_path = os.path.splitext(self.get_clean_record_path())[0] + '.epochs.json'
+        print("Writing epoch manifest '" + manifest_path + "'")
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.epoch_manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def write_deferred_epochs(self):
+        ''' Write the epochs held while monitor neurons were discovered,
+            reading their rows back from the run file a block at a time.
+        '''
+        deferred_epochs = self.deferred_epochs
+        self.deferred_epochs = []
+        self.discover_monitors = False
+        if not deferred_epochs:
+            return
+
+        blocks = iter_clean_run(self.get_run_path())
+        block = next(blocks, None)
+        for first_tick, end_tick, trigger_tick in deferred_epochs:
+            epoch_range = (first_tick, end_tick)
+            self.epoch_trigger_tick = trigger_tick
+            while block is not None and block[0] < epoch_range[1]:
+                rows = slice_block(block[0], block[1], epoch_range)
+                if rows is not None:
+                    self.epochoutput.append(rows)
+                if block[0] + len(block[1]) > epoch_range[1]:
+                    break   # The rest of the block belongs to the next epoch.
+                block = next(blocks, None)
+            self.write_cleaned_epoch()
+        blocks.close()
+
     def reset_epoch_output(self):
-        self.epochoutput = []   # Clear the epoch data, starting over with just a header row.
-        self.epochoutput.append(copy.copy(self.outputheader))
-        self.epochoutput.append(copy.copy(self.first_sample))
+        self.epochoutput = []   # Clear the epoch data, releasing its views of the run output.
+
+
+    def write_epoch_tensor(self):
+        ''' If export_epoch_tensor is set, write every epoch of the run as one
+            epochs x ticks x neurons array next to the configured clean output
+            file, with its extension replaced by '.epochs.npy' (and a '.json'
+            sidecar of neuron names and trigger ticks).  Each epoch is cut or
+            zero-padded to epoch_length ticks, by default the longest epoch's.
+            Unlike the epoch files, rows start at the epoch's first tick,
+            without a leading row of zeros.
+        '''
+        if not self.export_epoch_tensor:
+            return
 
+        tensor_path = os.path.splitext(self.get_clean_record_path())[0] + '.epochs.npy'
+        print("Writing epoch tensor '" + tensor_path + "'")
+        write_epoch_tensor(self.get_run_path(), self.epoch_manifest, tensor_path, self.epoch_length)
 
     def get_next_epoch_number(self, record_path):
         ''' Examine all the existing 'epochN.csv' files, looking
@@ -1,8 +1,10 @@
+import os
 import pandas as pd
 import matplotlib.pyplot as plt
 from pathlib import Path
 
 from support.configuration import Configuration
+from support.clean_run import load_clean_run
 
 ''' Using the cleaned record file (see mem.py),
     Add data to a line plot and save it to a file.
@@ -15,6 +17,9 @@ def plot_cleaned_run(configuration):
             
     filename = configuration.control['CleanRecordFile']
     clean_record_file = configuration.find_record_path().rstrip('/') + '/' + filename
+    columnar_record_file = os.path.splitext(clean_record_file)[0] + '.npz'
+    if os.path.exists(columnar_record_file):
+        clean_record_file = columnar_record_file
     print("Using clean record file '" + clean_record_file + "'")
 
     plot_from_file(configuration, clean_record_file, 'Full Run')
@@ -26,7 +31,11 @@ def plot_epochs(configuration):
         plot_from_file(configuration, str(epoc_data_path), str(epoc_data_path).split('/')[-1])
 
 def plot_from_file(configuration, filepath, title):
-    neurons = pd.read_csv(filepath, index_col=0)
+    if filepath.endswith('.npz'):
+        header, neuron_indices, ticks, values = load_clean_run(filepath)
+        neurons = pd.DataFrame(values, index=pd.Index(ticks, name=header[0]), columns=header[1:])
+    else:
+        neurons = pd.read_csv(filepath, index_col=0)
     show_lineplot(neurons, filepath, title)
 
 def show_lineplot(neurons, filepath, title):
@@ -39,7 +48,7 @@ def show_lineplot(neurons, filepath, title):
     ax.set_title(title)
     ax.legend()
     #plt.show()
-    image_file_path = filepath.replace('.csv', '.png')
+    image_file_path = os.path.splitext(filepath)[0] + '.png'
     print("Writing image file '" + image_file_path + "'")
     fig.savefig(image_file_path, dpi=100, bbox_inches='tight')
     plt.close('all')
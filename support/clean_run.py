@@ -0,0 +1,146 @@
+import os
+import json
+import zipfile
+import numpy as np
+
+""" Columnar storage for a cleaned run.
+    The run is a compressed .npz archive that np.load can open directly.
+    It holds a 'header' member (the column names, starting with 'time'),
+    a 'neuron_indices' member (the neuron index of each column after
+    'time'), and the activation rows as numbered blocks: 'block<N>' is a
+    ticks x neurons matrix whose first row is at tick 'block<N>_tick'.
+    Blocks are written as they are produced, and may be narrower than
+    the header when neurons were discovered later; their missing
+    columns are zero.  The archive is written under a temporary name,
+    and only appears at its own path once complete.
+
+    The run's epochs can also be exported as one epochs x ticks x neurons
+    array (see write_epoch_tensor), for slicing across epochs.
+"""
+
+class CleanRunWriter:
+  def __init__(self, path):
+    self.path = path
+    self.archive = zipfile.ZipFile(path + '.tmp', mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+    self.block_count = 0
+
+  def write_array(self, name, array):
+    with self.archive.open(name + '.npy', mode='w', force_zip64=True) as member:
+      np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+
+  def write_block(self, first_tick, matrix):
+    self.write_array('block' + str(self.block_count) + '_tick', np.array([first_tick], dtype=np.int64))
+    self.write_array('block' + str(self.block_count), matrix)
+    self.block_count += 1
+
+  def close(self, header, neuron_indices, synapse_indices=None):
+    """ Write the header members, close the archive and move it into place.
+        Runs whose columns are synapses also have a 'synapse_indices' member.
+    """
+    self.write_array('header', np.array(header))
+    self.write_array('neuron_indices', np.array(neuron_indices, dtype=np.int64))
+    if synapse_indices is not None:
+      self.write_array('synapse_indices', np.array(synapse_indices, dtype=np.int64))
+    self.archive.close()
+    os.replace(self.path + '.tmp', self.path)
+
+
+def write_clean_run(path, header, neuron_indices, blocks):
+  """ Write the (first tick, matrix) blocks of a cleaned run to path.
+  """
+  writer = CleanRunWriter(path)
+  for first_tick, matrix in blocks:
+    writer.write_block(first_tick, matrix)
+  writer.close(header, neuron_indices)
+
+def iter_clean_run(path):
+  """ Yield the (first tick, matrix) blocks of a cleaned run written by
+      CleanRunWriter one at a time, each padded to the full width.
+  """
+  with np.load(path, allow_pickle=False) as data:
+    width = len(data['neuron_indices'])
+    block_count = sum(1 for name in data.files if name.startswith('block') and not name.endswith('_tick'))
+    for block in range(block_count):
+      matrix = data['block' + str(block)]
+      first_tick = int(data['block' + str(block) + '_tick'][0])
+      if matrix.shape[1] < width:
+        matrix = np.hstack((matrix, np.zeros((len(matrix), width - matrix.shape[1]), dtype=matrix.dtype)))
+      yield first_tick, matrix
+
+def load_clean_run(path):
+  """ Read a cleaned run written by CleanRunWriter.  Return the header,
+      the neuron indices, the tick of each row and the activation matrix.
+  """
+  with np.load(path, allow_pickle=False) as data:
+    header = data['header'].tolist()
+    neuron_indices = data['neuron_indices']
+    width = len(neuron_indices)
+
+  ticks = []
+  blocks = []
+  for first_tick, matrix in iter_clean_run(path):
+    ticks.append(np.arange(first_tick, first_tick + len(matrix)))
+    blocks.append(matrix)
+
+  if not blocks:
+    return header, neuron_indices, np.empty(0, dtype=np.int64), np.empty((0, width), dtype=np.int32)
+
+  return header, neuron_indices, np.concatenate(ticks), np.vstack(blocks)
+
+def write_epoch_tensor(run_path, epochs, path, epoch_length=None):
+  """ Write the epochs of a cleaned run as a single epochs x ticks x neurons
+      .npy array at path, with a .json sidecar.  epochs are the entries of
+      the run's epoch manifest, in tick order.  Each epoch's rows start at
+      its first tick, and are truncated or zero-padded to epoch_length
+      ticks (default: the longest epoch).  The run is read a block at a
+      time and the array written through a memory map, so neither is held
+      in memory.  The sidecar holds the neuron names and indices, and the
+      number, first tick, trigger tick and full length of each epoch.
+  """
+  with np.load(run_path, allow_pickle=False) as data:
+    header = data['header'].tolist()
+    neuron_indices = data['neuron_indices'].tolist()
+    dtype = data['block0'].dtype if 'block0' in data.files else np.int32
+
+  lengths = [epoch['end_tick'] - epoch['first_tick'] for epoch in epochs]
+  if epoch_length is None:
+    epoch_length = max(lengths) if lengths else 0
+
+  tensor = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=(len(epochs), epoch_length, len(neuron_indices)))
+  blocks = iter_clean_run(run_path)
+  block = next(blocks, None)
+  for number, epoch in enumerate(epochs):
+    first_tick = epoch['first_tick']
+    end_tick = min(epoch['end_tick'], first_tick + epoch_length)
+    while block is not None and block[0] < end_tick:
+      block_tick, matrix = block
+      start = max(first_tick - block_tick, 0)
+      stop = min(end_tick - block_tick, len(matrix))
+      if stop > start:
+        tensor[number, block_tick + start - first_tick:block_tick + stop - first_tick] = matrix[start:stop]
+      if block_tick + len(matrix) > end_tick:
+        break   # The rest of the block belongs to later epochs.
+      block = next(blocks, None)
+  blocks.close()
+  tensor.flush()
+  del tensor
+  os.replace(path + '.tmp', path)
+
+  sidecar = {
+    'epoch_length': epoch_length,
+    'neurons': header[1:],
+    'neuron_indices': neuron_indices,
+    'epochs': [epoch['epoch'] for epoch in epochs],
+    'first_ticks': [epoch['first_tick'] for epoch in epochs],
+    'trigger_ticks': [epoch['trigger_tick'] for epoch in epochs],
+    'lengths': lengths
+  }
+  with open(path + '.json', 'w') as f:
+    json.dump(sidecar, f, indent=2)
+
+def load_epoch_tensor(path):
+  """ Memory-map an epoch tensor written by write_epoch_tensor, and return it with its sidecar.
+  """
+  with open(path + '.json') as f:
+    sidecar = json.load(f)
+  return np.load(path, mmap_mode='r'), sidecar
@@ -0,0 +1,596 @@
+import os
+import io
+import csv
+import copy
+import json
+import functools
+import multiprocessing
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+""" Columnar access to engine record files.
+    A record file is parsed into a NumPy structured array with one
+    typed field per record column, rather than a dict per row.
+    'N/A' values (synapse fields on non-synapse events) become
+    NOT_AVAILABLE.  Timestamps become int64 nanoseconds since
+    1970-01-01, taking the recorded (local) time as-is.
+
+    The first parse of a record file also writes a binary sidecar
+    next to it (ModelEngineRecord.csv.columns, plus a .json key).
+    While the record file keeps the same size and modification time,
+    later loads memory-map the sidecar instead of parsing the CSV.
+
+    Readers may be given a RecordFilter, so that rows no caller wants
+    are dropped as each chunk is parsed, before their timestamps are
+    decoded or their columns assembled.  The first parse of a file
+    that is to be cached keeps every row for the sidecar, and filters
+    afterwards.
+"""
+
+cache_version = 2
+parallel_range_size = 1 << 25
+
+NOT_AVAILABLE = np.iinfo(np.int32).min
+
+record_dtype = np.dtype([
+  ('tick', np.int64),
+  ('time', np.int64),
+  ('event_type', np.int8),
+  ('neuron_index', np.int32),
+  ('activation', np.int32),
+  ('hypersensitive', np.int8),
+  ('synapse_index', np.int32),
+  ('synapse_strength', np.int32)
+])
+
+# Record file column name for each field of record_dtype.
+record_columns = {
+  'tick': 'tick',
+  'time': 'time',
+  'Neuron-Event-Type': 'event_type',
+  'Neuron-Index': 'neuron_index',
+  'Neuron-Activation': 'activation',
+  'Hypersensitive': 'hypersensitive',
+  'Synapse-Index': 'synapse_index',
+  'Synapse-Strength': 'synapse_strength'
+}
+
+read_options = { 'usecols': list(record_columns), 'na_values': ['N/A'], 'keep_default_na': False }
+
+
+unix_epoch = datetime(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time_prefix(prefix):
+  """ Parse the whole-second part of a record timestamp, such as
+      '2023-01-01 12:00:01'.  Thousands of consecutive rows share each
+      prefix, so parsed values are cached.
+  """
+  return datetime.fromisoformat(prefix)
+
+@functools.lru_cache(maxsize=4096)
+def parse_time_prefix_seconds(prefix):
+  return (parse_time_prefix(prefix) - unix_epoch) // timedelta(seconds=1)
+
+def decode_timestamps(times):
+  """ Convert a column of record timestamps, such as
+      '2023-01-01 12:00:01.960000257', into int64 nanoseconds since
+      1970-01-01.  As elsewhere, the digits after the '.' are taken
+      as nanoseconds.  Each run of rows sharing a whole-second prefix
+      is parsed once.
+  """
+  encoded = np.asarray(times).astype('S')
+  width = encoded.dtype.itemsize
+  if len(encoded) == 0:
+    return np.empty(0, dtype=np.int64)
+
+  # Fast path: every timestamp has the same layout, so decode the characters as a matrix.
+  characters = encoded.view(np.uint8).reshape(len(encoded), width)
+  digits = characters[:, 20:].astype(np.int64) - ord('0')
+  if width > 20 and (characters[:, 19] == ord('.')).all() and ((digits >= 0) & (digits <= 9)).all():
+    nanoseconds = digits @ (10 ** np.arange(width - 21, -1, -1, dtype=np.int64))
+    prefixes = characters[:, :19]
+    run_starts = np.ones(len(prefixes), dtype=bool)
+    run_starts[1:] = (prefixes[1:] != prefixes[:-1]).any(axis=1)
+    run_starts = np.flatnonzero(run_starts)
+    run_seconds = [parse_time_prefix_seconds(prefixes[start].tobytes().decode()) for start in run_starts.tolist()]
+    seconds = np.repeat(np.array(run_seconds, dtype=np.int64), np.diff(np.append(run_starts, len(prefixes))))
+    return seconds * 1000000000 + nanoseconds
+
+  parts = pd.Series(times, dtype=object).str.partition('.')
+  codes, prefixes = pd.factorize(parts[0])
+  seconds = np.array([parse_time_prefix_seconds(prefix) for prefix in prefixes], dtype=np.int64)
+  nanoseconds = pd.to_numeric(parts[2].replace('', '0')).to_numpy(dtype=np.int64)
+  return seconds[codes] * 1000000000 + nanoseconds
+
+def empty_records():
+  return np.empty(0, dtype=record_dtype)
+
+
+class RecordFilter:
+  """ The rows of a record wanted by a reader: event types in
+      event_types, neurons in neurons (indexes, or range objects of
+      indexes), and first_tick <= tick < end_tick.  Omitted criteria
+      accept every row.  Neurons and ticks are as the caller sees them,
+      with deployment and tick offsets applied; use shifted() to get
+      the equivalent filter for the raw values in one record file.
+  """
+  def __init__(self, event_types=None, neurons=None, first_tick=None, end_tick=None):
+    self.event_types = np.array(list(event_types), dtype=np.int64) if event_types is not None else None
+    self.neuron_indices = None
+    self.neuron_ranges = []
+    if neurons is not None:
+      self.neuron_indices = np.array([neuron for neuron in neurons if not isinstance(neuron, range)], dtype=np.int64)
+      self.neuron_ranges = [(neuron.start, neuron.stop) for neuron in neurons if isinstance(neuron, range)]
+    self.first_tick = first_tick
+    self.end_tick = end_tick
+
+  def shifted(self, deployment_offset=0, tick_offset=0):
+    """ Return this filter for neuron indexes and ticks before the given offsets are added.
+    """
+    shifted = copy.copy(self)
+    if self.neuron_indices is not None:
+      shifted.neuron_indices = self.neuron_indices - deployment_offset
+      shifted.neuron_ranges = [(start - deployment_offset, stop - deployment_offset) for start, stop in self.neuron_ranges]
+    if self.first_tick is not None:
+      shifted.first_tick = self.first_tick - tick_offset
+    if self.end_tick is not None:
+      shifted.end_tick = self.end_tick - tick_offset
+    return shifted
+
+  def mask(self, ticks, event_types, neuron_indices):
+    """ Return a mask of the rows with these ticks, event types and neuron indexes that pass the filter.
+    """
+    selected = np.ones(len(ticks), dtype=bool)
+    if self.event_types is not None:
+      selected &= np.isin(event_types, self.event_types)
+    if self.neuron_indices is not None:
+      neuron_selected = np.isin(neuron_indices, self.neuron_indices)
+      for start, stop in self.neuron_ranges:
+        neuron_selected |= (neuron_indices >= start) & (neuron_indices < stop)
+      selected &= neuron_selected
+    if self.first_tick is not None:
+      selected &= ticks >= self.first_tick
+    if self.end_tick is not None:
+      selected &= ticks < self.end_tick
+    return selected
+
+  def select(self, records):
+    return records[self.mask(records['tick'], records['event_type'], records['neuron_index'])]
+
+
+def filter_records(records, record_filter=None):
+  """ Return the records that pass the filter, or all of them if there is none.
+  """
+  if record_filter is None:
+    return records
+  return record_filter.select(records)
+
+def records_from_frame(frame, record_filter=None):
+  """ Convert a pandas frame read from a record file into a structured
+      array, keeping only the rows that pass record_filter, if given.
+      The filter is applied to the integer columns first, so rejected
+      rows are never converted.
+  """
+  selected = None
+  if record_filter is not None:
+    selected = record_filter.mask(frame['tick'].to_numpy(), frame['Neuron-Event-Type'].to_numpy(), frame['Neuron-Index'].to_numpy())
+
+  records = np.empty(len(frame) if selected is None else np.count_nonzero(selected), dtype=record_dtype)
+  for column, field in record_columns.items():
+    values = frame[column]
+    if selected is not None:
+      values = values[selected]
+    if field == 'time':
+      records[field] = decode_timestamps(values)
+      continue
+    if values.hasnans:
+      values = values.fillna(NOT_AVAILABLE)
+    records[field] = values.to_numpy()
+
+  return records
+
+def read_record_frames(filename, chunk_size=None):
+  """ Yield the record file as pandas frames of at most chunk_size rows,
+      or as a single frame if chunk_size is None.
+  """
+  if not chunk_size:
+    yield pd.read_csv(filename, **read_options)
+    return
+
+  with pd.read_csv(filename, chunksize=chunk_size, **read_options) as reader:
+    for frame in reader:
+      yield frame
+
+def read_first_tick(filename):
+  """ Return the tick of the first row of the record file, or None if
+      it has no rows.  Only the header and first row are read.
+  """
+  with open(filename, newline='') as f:
+    reader = csv.reader(f)
+    header = next(reader, None)
+    row = next(reader, None)
+
+  if header is None or row is None:
+    return None
+  return int(row[header.index('tick')])
+
+def get_cache_paths(filename):
+  return filename + '.columns', filename + '.columns.json'
+
+def get_cache_key(filename):
+  stat = os.stat(filename)
+  return { 'version': cache_version, 'dtype': str(record_dtype), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+def open_record_cache(filename):
+  """ Memory-map the sidecar of the record file, if it exists and
+      matches the record file's current size and modification time.
+      Return None otherwise.
+  """
+  data_path, key_path = get_cache_paths(filename)
+  try:
+    with open(key_path) as f:
+      key = json.load(f)
+    expected_key = get_cache_key(filename)
+  except (OSError, ValueError):
+    return None
+
+  for name, value in expected_key.items():
+    if key.get(name) != value:
+      return None
+
+  if key['rows'] == 0:
+    return empty_records()
+
+  try:
+    return np.memmap(data_path, dtype=record_dtype, mode='r', shape=(key['rows'],))
+  except (OSError, ValueError):
+    return None
+
+
+class RecordCacheWriter:
+  """ Write parsed record chunks to a temporary sidecar, and publish it
+      (data first, then key) only once the whole record file is parsed.
+      Failure to write the sidecar is reported but never fatal.
+  """
+  def __init__(self, filename):
+    self.data_path, self.key_path = get_cache_paths(filename)
+    self.key = get_cache_key(filename)
+    self.rows = 0
+    try:
+      self.file = open(self.data_path + '.tmp', 'wb')
+    except OSError as err:
+      print('Unable to write record cache ' + self.data_path + ': ' + str(err))
+      self.file = None
+
+  def write(self, records):
+    if self.file:
+      records.tofile(self.file)
+      self.rows += len(records)
+
+  def commit(self):
+    if not self.file:
+      return
+
+    self.file.close()
+    self.file = None
+    self.key['rows'] = self.rows
+    try:
+      os.replace(self.data_path + '.tmp', self.data_path)
+      with open(self.key_path + '.tmp', 'w') as f:
+        json.dump(self.key, f)
+      os.replace(self.key_path + '.tmp', self.key_path)
+    except OSError as err:
+      print('Unable to write record cache ' + self.data_path + ': ' + str(err))
+
+  def abandon(self):
+    if self.file:
+      self.file.close()
+      self.file = None
+      os.remove(self.data_path + '.tmp')
+
+
+def load_record_columns(filename, use_cache=True, record_filter=None):
+  """ Parse the whole record file into a structured array.
+  """
+  return merge_records(list(iter_record_columns(filename, None, use_cache, record_filter)))
+
+def split_record_file(filename, parts):
+  """ Return the header line of the record file, and up to parts
+      (start, end) byte ranges covering its rows, each starting and
+      ending on a line boundary.
+  """
+  size = os.path.getsize(filename)
+  with open(filename, 'rb') as f:
+    header = f.readline()
+    data_start = f.tell()
+    bounds = [data_start]
+    for part in range(1, parts):
+      f.seek(data_start + (size - data_start) * part // parts)
+      f.readline()
+      bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+
+  ranges = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+  return header, ranges
+
+def parse_record_range(filename, header, start, end, record_filter=None):
+  """ Parse the rows in one byte range of the record file.
+  """
+  with open(filename, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+
+  return records_from_frame(pd.read_csv(io.BytesIO(header + data), **read_options), record_filter)
+
+def parse_record_range_task(task):
+  return parse_record_range(*task)
+
+def load_record_columns_parallel(filename, use_cache=True, processes=None, record_filter=None):
+  """ Parse one record file by splitting it at line boundaries into
+      byte ranges parsed by a pool of worker processes, then joining
+      the ranges back in tick order.  Ranges are at most about
+      parallel_range_size bytes, so a worker only ever holds one bounded
+      range's text and frame, however large the file.  When the sidecar
+      is to be written, every row is parsed for it, and the filter
+      applied afterwards.
+  """
+  parse_filter = record_filter
+  if use_cache:
+    cached = open_record_cache(filename)
+    if cached is not None:
+      print('Using record cache for ' + filename)
+      return filter_records(cached, record_filter)
+    cache_writer = RecordCacheWriter(filename)
+    parse_filter = None
+
+  try:
+    pool_size = processes if processes else os.cpu_count()
+    range_count = max(pool_size, -(-os.path.getsize(filename) // parallel_range_size))
+    header, ranges = split_record_file(filename, range_count)
+    if len(ranges) <= 1:
+      records = load_record_columns(filename, False, parse_filter)
+    else:
+      with multiprocessing.Pool(min(pool_size, len(ranges))) as pool:
+        tasks = [(filename, header, start, end, parse_filter) for start, end in ranges]
+        parts = list(pool.imap(parse_record_range_task, tasks))
+      records = np.concatenate(parts)
+      if np.any(np.diff(records['tick']) < 0):
+        records = records[np.argsort(records['tick'], kind='stable')]
+  except:
+    if use_cache:
+      cache_writer.abandon()
+    raise
+
+  if use_cache:
+    cache_writer.write(records)
+    cache_writer.commit()
+
+  return filter_records(records, record_filter)
+
+def load_record_files(filenames, use_cache=True, processes=None, record_filters=None):
+  """ Parse several record files, each in its own worker process, and
+      return their structured arrays in the order given.  Files with a
+      current sidecar are memory-mapped here instead of being sent to
+      a worker.  A single file left to parse is split across the pool
+      by byte range instead.  processes limits the pool size (default:
+      CPU count).  record_filters, if given, holds a RecordFilter (or
+      None) for each file.
+  """
+  if record_filters is None:
+    record_filters = [None] * len(filenames)
+
+  results = [open_record_cache(filename) if use_cache else None for filename in filenames]
+  results = [filter_records(columns, record_filter) if columns is not None else None for columns, record_filter in zip(results, record_filters)]
+  pending = [index for index, columns in enumerate(results) if columns is None]
+  if len(pending) == 1:
+    results[pending[0]] = load_record_columns_parallel(filenames[pending[0]], use_cache, processes, record_filters[pending[0]])
+  elif pending:
+    pool_size = min(processes if processes else os.cpu_count(), len(pending))
+    with multiprocessing.Pool(pool_size) as pool:
+      parsed = pool.starmap(load_record_columns, [(filenames[index], use_cache, record_filters[index]) for index in pending])
+    for index, columns in zip(pending, parsed):
+      results[index] = columns
+
+  return results
+
+def iter_record_columns(filename, chunk_size=None, use_cache=True, record_filter=None):
+  """ Parse the record file into structured arrays of at most chunk_size
+      rows, keeping only the rows that pass record_filter, if given.
+      With use_cache, serve the rows from the sidecar when it is current,
+      and write the sidecar when it is not, filtering each chunk only
+      once it is written, since the sidecar must hold every row.
+  """
+  cached = open_record_cache(filename) if use_cache else None
+  if cached is not None:
+    print('Using record cache for ' + filename)
+    if not chunk_size:
+      yield filter_records(cached, record_filter)
+      return
+
+    for start in range(0, len(cached), chunk_size):
+      yield filter_records(cached[start:start + chunk_size], record_filter)
+    return
+
+  if not use_cache:
+    for frame in read_record_frames(filename, chunk_size):
+      yield records_from_frame(frame, record_filter)
+    return
+
+  cache_writer = RecordCacheWriter(filename)
+  completed = False
+  try:
+    for frame in read_record_frames(filename, chunk_size):
+      records = records_from_frame(frame)
+      cache_writer.write(records)
+      yield filter_records(records, record_filter)
+    completed = True
+  finally:
+    if completed:
+      cache_writer.commit()
+    else:
+      cache_writer.abandon()
+
+class RecordTail:
+  """ Follow a record file that is still being written.  Each poll
+      parses just the complete rows appended since the last one,
+      holding back any partial last line until it is finished.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.file = None
+    self.header = None
+    self.partial = b''
+
+  def poll(self):
+    if self.file is None:
+      try:
+        self.file = open(self.filename, 'rb')
+      except OSError:
+        return empty_records()   # Not created yet.
+
+    data = self.partial + self.file.read()
+    if self.header is None:
+      header_end = data.find(b'\n') + 1
+      if header_end == 0:
+        self.partial = data
+        return empty_records()
+      self.header = data[:header_end]
+      data = data[header_end:]
+
+    rows_end = data.rfind(b'\n') + 1
+    self.partial = data[rows_end:]
+    if rows_end == 0:
+      return empty_records()
+
+    return records_from_frame(pd.read_csv(io.BytesIO(self.header + data[:rows_end]), **read_options))
+
+  def close(self):
+    if self.file:
+      self.file.close()
+      self.file = None
+
+
+def offset_records(records, deployment_offset=0, tick_offset=0):
+  """ Shift neuron indexes by the deployment offset and ticks by the
+      tick offset as single vectorized adds.  The records are returned
+      unchanged (not copied) when both offsets are zero.
+  """
+  if deployment_offset == 0 and tick_offset == 0:
+    return records
+
+  records = records.copy()
+  if deployment_offset != 0:
+    records['neuron_index'] += deployment_offset
+  if tick_offset != 0:
+    records['tick'] += tick_offset
+
+  return records
+
+def merge_two_runs(first, second):
+  """ Merge two runs of (ticks, row positions) in tick order, placing
+      each row of first directly at its merged position (rows of first
+      come before those of second at equal ticks).  The rows of second
+      fill the remaining places, in order.
+  """
+  first_places = np.arange(len(first[0])) + np.searchsorted(second[0], first[0], side='left')
+  second_places = np.ones(len(first[0]) + len(second[0]), dtype=bool)
+  second_places[first_places] = False
+  ticks = np.empty(len(second_places), dtype=first[0].dtype)
+  positions = np.empty(len(second_places), dtype=np.int64)
+  ticks[first_places] = first[0]
+  ticks[second_places] = second[0]
+  positions[first_places] = first[1]
+  positions[second_places] = second[1]
+  return ticks, positions
+
+def merge_records(parts):
+  """ Merge tick-ordered record arrays into one tick-ordered array.  This
+      is a k-way merge, run as rounds of pairwise merges of neighbouring
+      parts' ticks, so each row's tick is placed O(log k) times for k
+      parts and no sort is needed.  The rows themselves are gathered
+      once, at the end.
+      Rows with equal ticks keep the order of parts.
+  """
+  parts = [part for part in parts if len(part) > 0]
+  if not parts:
+    return empty_records()
+  if len(parts) == 1:
+    return parts[0]
+
+  starts = np.cumsum([0] + [len(part) for part in parts])
+  runs = [(np.ascontiguousarray(part['tick']), np.arange(start, start + len(part))) for part, start in zip(parts, starts)]
+  while len(runs) > 1:
+    merged = [merge_two_runs(runs[index], runs[index + 1]) for index in range(0, len(runs) - 1, 2)]
+    if len(runs) % 2 == 1:
+      merged.append(runs[-1])
+    runs = merged
+  return np.concatenate(parts)[runs[0][1]]
+
+def merge_record_streams(streams):
+  """ Merge several iterators of tick-ordered record chunks into a
+      single iterator of tick-ordered chunks.  A tick is only released
+      once every stream has buffered past it, so all rows for a tick
+      arrive in the same chunk.  The released rows of the streams are
+      k-way merged (see merge_records).
+  """
+  pending = []
+  live = []
+  for stream in streams:
+    pending.append(empty_records())
+    live.append(True)
+
+  while True:
+    for index, stream in enumerate(streams):
+      while live[index] and len(pending[index]) == 0:
+        chunk = next(stream, None)
+        if chunk is None:
+          live[index] = False
+        else:
+          pending[index] = chunk
+
+    limits = [pending[index]['tick'][-1] for index in range(len(streams)) if live[index]]
+    if not limits:
+      remaining = merge_records(pending)
+      if len(remaining) > 0:
+        yield remaining
+      return
+
+    limit = min(limits)
+    ready = [np.searchsorted(part['tick'], limit, side='left') for part in pending]
+    if sum(ready) == 0:
+      # Every buffered row is at the limit tick; read further into the streams holding it.
+      for index, stream in enumerate(streams):
+        if live[index] and pending[index]['tick'][-1] == limit:
+          chunk = next(stream, None)
+          if chunk is None:
+            live[index] = False
+          else:
+            pending[index] = np.concatenate([pending[index], chunk])
+      continue
+
+    parts = []
+    for index, count in enumerate(ready):
+      parts.append(pending[index][:count])
+      pending[index] = pending[index][count:]
+    yield merge_records(parts)
+
+def record_sample(records, position):
+  """ Return one row of the records as a sample dict, as passed to a
+      trigger callback and returned by RecordFileParser.get_current_sample:
+      the record column names, with None for N/A synapse fields.
+  """
+  row = records[position]
+  synapse_index = int(row['synapse_index'])
+  synapse_strength = int(row['synapse_strength'])
+  return {
+    'tick': int(row['tick']),
+    'Neuron-Event-Type': int(row['event_type']),
+    'Neuron-Index': int(row['neuron_index']),
+    'Neuron-Activation': int(row['activation']),
+    'Hypersensitive': int(row['hypersensitive']),
+    'Synapse-Index': synapse_index if synapse_index != NOT_AVAILABLE else None,
+    'Synapse-Strength': synapse_strength if synapse_strength != NOT_AVAILABLE else None
+  }
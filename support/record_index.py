@@ -0,0 +1,172 @@
+import os
+import json
+import numpy as np
+
+from support.record_columns import open_record_cache, parse_record_range, decode_timestamps, empty_records
+
+""" Windowed access to engine record files.
+    A record file's index holds the tick, time and byte offset of every
+    stride'th row, and is stored next to the record file
+    (ModelEngineRecord.csv.index, plus a .json key of the record file's
+    size and modification time).  It is built once, by a single scan
+    for line boundaries.  A tick or time window is then read by seeking
+    to the nearest indexed row before it and parsing only the rows up
+    to the window's end.
+"""
+
+index_version = 1
+default_stride = 4096
+scan_block_size = 1 << 24
+
+index_dtype = np.dtype([
+  ('tick', np.int64),
+  ('time', np.int64),
+  ('offset', np.int64)
+])
+
+
+def get_index_paths(filename):
+  return filename + '.index', filename + '.index.json'
+
+def get_index_key(filename, stride):
+  stat = os.stat(filename)
+  return { 'version': index_version, 'stride': stride, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+def open_record_index(filename, stride=default_stride):
+  """ Return the stored index of the record file, if it exists and
+      matches the record file's current size and modification time.
+      Return None otherwise.
+  """
+  data_path, key_path = get_index_paths(filename)
+  try:
+    with open(key_path) as f:
+      key = json.load(f)
+    if key != get_index_key(filename, stride):
+      return None
+    return np.load(data_path)
+  except (OSError, ValueError):
+    return None
+
+def build_record_index(filename, stride=default_stride):
+  """ Scan the record file for the start of every stride'th complete
+      row, and return the tick, time and byte offset of each.
+  """
+  offsets = []
+  with open(filename, 'rb') as f:
+    header = f.readline()
+    names = header.decode().strip().split(',')
+    tick_column = names.index('tick')
+    time_column = names.index('time')
+
+    row_start = f.tell()
+    row_number = 0
+    block_start = row_start
+    while True:
+      block = f.read(scan_block_size)
+      if not block:
+        break
+      # Each newline ends one row; the next row starts just after it.
+      row_ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + block_start + 1
+      row_starts = np.concatenate(([row_start], row_ends[:-1]))
+      if len(row_ends) > 0:
+        sampled = (np.arange(row_number, row_number + len(row_ends)) % stride) == 0
+        offsets.extend(row_starts[sampled].tolist())
+        row_number += len(row_ends)
+        row_start = int(row_ends[-1])
+      block_start += len(block)
+
+    ticks = []
+    times = []
+    for offset in offsets:
+      f.seek(offset)
+      fields = f.readline().decode().split(',')
+      ticks.append(int(fields[tick_column]))
+      times.append(fields[time_column])
+
+  index = np.empty(len(offsets), dtype=index_dtype)
+  index['tick'] = ticks
+  index['time'] = decode_timestamps(np.array(times, dtype=object)) if times else []
+  index['offset'] = offsets
+  return index
+
+def load_record_index(filename, stride=default_stride):
+  """ Return the index of the record file, building and storing it first
+      if there is no current one.  Failure to store it is not fatal.
+  """
+  index = open_record_index(filename, stride)
+  if index is not None:
+    return index
+
+  print('Indexing record file ' + filename)
+  key = get_index_key(filename, stride)
+  index = build_record_index(filename, stride)
+  data_path, key_path = get_index_paths(filename)
+  try:
+    with open(data_path + '.tmp', 'wb') as f:
+      np.save(f, index)
+    os.replace(data_path + '.tmp', data_path)
+    with open(key_path + '.tmp', 'w') as f:
+      json.dump(key, f)
+    os.replace(key_path + '.tmp', key_path)
+  except OSError as err:
+    print('Unable to write record index ' + data_path + ': ' + str(err))
+
+  return index
+
+def get_first_tick(filename, use_cache=True):
+  """ Return the tick of the first row of the record file, or None if it has no rows.
+  """
+  cached = open_record_cache(filename) if use_cache else None
+  if cached is not None:
+    return int(cached['tick'][0]) if len(cached) > 0 else None
+
+  index = load_record_index(filename)
+  return int(index['tick'][0]) if len(index) > 0 else None
+
+def in_window(values, first, end):
+  selected = np.ones(len(values), dtype=bool)
+  if first is not None:
+    selected &= values >= first
+  if end is not None:
+    selected &= values < end
+  return selected
+
+def iter_record_window(filename, first_tick=None, end_tick=None, first_time=None, end_time=None, use_cache=True, entries_per_chunk=16):
+  """ Yield the rows of the record file with first_tick <= tick < end_tick
+      and first_time <= time < end_time (nanoseconds, see record_columns),
+      as structured arrays.  Omitted bounds are open.  When the columnar
+      sidecar is current, the window is sliced from it directly.
+  """
+  field, first, end = 'tick', first_tick, end_tick
+  if first_tick is None and end_tick is None:
+    field, first, end = 'time', first_time, end_time
+
+  cached = open_record_cache(filename) if use_cache else None
+  if cached is not None:
+    keys = cached[field]
+    start = np.searchsorted(keys, first, side='left') if first is not None else 0
+    stop = np.searchsorted(keys, end, side='left') if end is not None else len(cached)
+    window = cached[start:stop]
+    yield window[in_window(window['time'], first_time, end_time)]
+    return
+
+  index = load_record_index(filename)
+  if len(index) == 0:
+    yield empty_records()
+    return
+
+  keys = index[field]
+  # Start at the last indexed row before the window; stop at the first indexed row past it.
+  first_entry = max(np.searchsorted(keys, first, side='left') - 1, 0) if first is not None else 0
+  end_entry = np.searchsorted(keys, end, side='left') if end is not None else len(index)
+  bounds = index['offset'][first_entry:end_entry].tolist()
+  bounds.append(int(index['offset'][end_entry]) if end_entry < len(index) else os.path.getsize(filename))
+
+  with open(filename, 'rb') as f:
+    header = f.readline()
+
+  for entry in range(0, len(bounds) - 1, entries_per_chunk):
+    start = bounds[entry]
+    stop = bounds[min(entry + entries_per_chunk, len(bounds) - 1)]
+    records = parse_record_range(filename, header, start, stop)
+    yield records[in_window(records['tick'], first_tick, end_tick) & in_window(records['time'], first_time, end_time)]
@@ -0,0 +1,118 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+from support.record_columns import load_record_files
+
+""" Parsed record columns held once in shared memory.
+    A RecordStore copies each structured array of record columns (see
+    support.record_columns) into its own multiprocessing.shared_memory
+    block, under a name of the caller's choosing.  Worker processes
+    attach to the blocks by those names through the store's handles, and
+    get NumPy views onto the same memory rather than copies.  Workers
+    should be children of the process owning the store (e.g. pool
+    workers), which shares its resource tracker; the owner frees the
+    blocks with close().
+"""
+
+def get_handle(block, records):
+  return { 'block': block.name, 'dtype': records.dtype.descr, 'length': len(records) }
+
+def view_block(block, handle):
+  return np.ndarray((handle['length'],), dtype=np.dtype(handle['dtype']), buffer=block.buf)
+
+
+class RecordStore:
+  def __init__(self):
+    self.blocks = {}
+    self.handles = {}
+    self.views = {}
+
+  def add(self, name, records):
+    """ Copy the records into a new shared memory block stored as name, and return a view of it.
+    """
+    if name in self.blocks:
+      raise ValueError('Record store already holds ' + name)
+
+    block = shared_memory.SharedMemory(create=True, size=max(records.nbytes, 1))
+    handle = get_handle(block, records)
+    view = view_block(block, handle)
+    view[:] = records
+    self.blocks[name] = block
+    self.handles[name] = handle
+    self.views[name] = view
+    return view
+
+  def load(self, filenames, names=None, use_cache=True, processes=None, record_filters=None):
+    """ Parse the record files as load_record_files does, and store each
+        under its name (default: its filename).  Return their views.
+    """
+    if names is None:
+      names = filenames
+    records = load_record_files(filenames, use_cache, processes, record_filters)
+    return [self.add(name, columns) for name, columns in zip(names, records)]
+
+  def get(self, name):
+    return self.views[name]
+
+  def get_handles(self):
+    """ Return the handles for attaching to the stored records, by name.
+        They can be passed to worker processes.
+    """
+    return dict(self.handles)
+
+  def close(self):
+    """ Close and free every block.  Views of the records must not be used after this.
+    """
+    self.views = {}
+    for block in self.blocks.values():
+      try:
+        block.close()
+      except BufferError:
+        pass    # A view is still held; the memory is released when it goes.
+      block.unlink()
+    self.blocks = {}
+    self.handles = {}
+
+
+class RecordStoreReader:
+  """ A worker's access to the records of a RecordStore, from its handles.
+      Blocks are attached as their records are first asked for, and the
+      views are read-only.
+  """
+  def __init__(self, handles):
+    self.handles = handles
+    self.blocks = {}
+    self.views = {}
+
+  def get(self, name):
+    if name not in self.views:
+      handle = self.handles[name]
+      block = shared_memory.SharedMemory(name=handle['block'])
+      view = view_block(block, handle)
+      view.flags.writeable = False
+      self.blocks[name] = block
+      self.views[name] = view
+    return self.views[name]
+
+  def close(self):
+    self.views = {}
+    for block in self.blocks.values():
+      try:
+        block.close()
+      except BufferError:
+        pass
+    self.blocks = {}
+
+
+shared_records = None
+
+def attach_record_store(handles):
+  """ Attach this process to a RecordStore's records.  Suitable as a
+      multiprocessing.Pool initializer, with the store's handles as its
+      argument; workers then call get_shared_records.
+  """
+  global shared_records
+  shared_records = RecordStoreReader(handles)
+
+def get_shared_records(name):
+  return shared_records.get(name)
@@ -23,15 +23,8 @@ def record(config):
   recording.print()
   return recording
 
-def getSynapticStrengths(epochs, neuronIndex, synapseIndex):
-  strengths = []
-  for epoch in epochs:
-    neuronEvents = filter(lambda event: event.neuron_index == neuronIndex, epoch.events)
-    for event in neuronEvents:
-      adjustments = filter(lambda adjustment: adjustment.synapse_index == synapseIndex, event.synapse_adjustments)
-      for adjustment in adjustments:
-        strengths.append(adjustment.synapse_strength)
-
+def getSynapticStrengths(engine_record, neuronIndex, synapseIndex):
+  ticks, strengths = engine_record.get_strength_trajectory(neuronIndex, synapseIndex)
   return strengths
 
 def duration_per_tick(epochs, epoch):
@@ -141,8 +134,8 @@ class TestAnticipate:
       assert ms_per_tick == engine_period / 1000
 
   def test_N1_N2_synapse_increases(self, test_engines, test_epochs, record):
-    for epochs in record.records:
-      strengths = getSynapticStrengths(epochs, NeuronAssignments.N2, 1)
+    for engine_record in record.engine_records:
+      strengths = getSynapticStrengths(engine_record, NeuronAssignments.N2, 1)
       assert len(strengths) > 0
       assert strengths[len(strengths) - 1] > strengths[0]
     
@@ -0,0 +1,113 @@
+import os
+import csv
+import random
+from datetime import datetime, timedelta
+import pytest
+from analysis.anticipate_record import AnticipateRun
+
+
+header = 'tick,time,Neuron-Index,Neuron-Event-Type,Neuron-Activation,Hypersensitive,Synapse-Index,Synapse-Strength\n'
+epoch_neuron = 1
+
+def write_record(path, seed, ticks=2000):
+  """ Write a synthetic engine record: spikes of the epoch neuron every 150
+      ticks or so, other spikes, decays and synapse adjustments in between,
+      and adjustments and spikes before the first epoch.  The record
+      crosses midnight.
+  """
+  rnd = random.Random(seed)
+  moment = datetime(2023, 1, 30, 23, 59, 59)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    f.write(header)
+    for tick in range(100, 100 + ticks):
+      moment += timedelta(microseconds=rnd.randint(500, 1500))
+      time = moment.strftime('%Y-%m-%d %H:%M:%S') + '.' + str(moment.microsecond * 1000 + rnd.randint(0, 999)).zfill(9)
+      if tick == 100:
+        f.write('%d,%s,3,4,10,0,1,42\n' % (tick, time))
+        f.write('%d,%s,3,2,100,0,N/A,N/A\n' % (tick, time))
+        f.write('%d,%s,3,4,10,0,2,43\n' % (tick, time))
+      if tick > 130 and rnd.random() < 1 / 150:
+        f.write('%d,%s,%d,2,100,0,N/A,N/A\n' % (tick, time, epoch_neuron))
+      for row in range(rnd.randint(0, 3)):
+        event_type = rnd.choice([1, 2, 4, 4, 4])
+        neuron = rnd.randint(2, 6)
+        if event_type == 4:
+          f.write('%d,%s,%d,4,%d,0,%d,%d\n' % (tick, time, rnd.randint(1, 6), rnd.randint(-50, 100), rnd.randint(0, 3), rnd.randint(-100, 100)))
+        else:
+          f.write('%d,%s,%d,%d,%d,0,N/A,N/A\n' % (tick, time, neuron, event_type, rnd.randint(-50, 100)))
+
+def read_reference_epochs(filename):
+  """ The epochs of a record file as read row by row, by the original
+      csv.DictReader loader: each a list of (tick, neuron, time delta,
+      adjustments) events, with adjustments as (neuron, synapse, strength,
+      tick).
+  """
+  epochs = []
+  with open(filename, newline='') as record_file:
+    for row in csv.DictReader(record_file):
+      neuron = int(row['Neuron-Index'])
+      event_type = int(row['Neuron-Event-Type'])
+      if neuron == epoch_neuron and event_type == 2:
+        epochs.append([])
+      if not epochs:
+        continue
+      if event_type == 2:
+        prefix, nanoseconds = row['time'].split('.')
+        moment = datetime.strptime(prefix, '%Y-%m-%d %H:%M:%S')
+        delta = timedelta(days=moment.day, hours=moment.hour, minutes=moment.minute, seconds=moment.second, microseconds=round(int(nanoseconds) / 1000))
+        epochs[-1].append((int(row['tick']), neuron, delta, []))
+      elif event_type == 4 and epochs[-1]:
+        epochs[-1][-1][3].append((neuron, int(row['Synapse-Index']), int(row['Synapse-Strength']), int(row['tick'])))
+  return epochs
+
+@pytest.fixture
+def record_path(tmp_path):
+  for seed, engine in enumerate(['Research1', 'Research2']):
+    write_record(str(tmp_path) + '/' + engine + '/ModelEngineRecord.csv', seed)
+  return str(tmp_path) + '/{engineName}/ModelEngineRecord.csv'
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_epochs_match_row_by_row_reading(record_path, use_cache):
+  """ The epochs, events and adjustments read from the shared arrays are
+      those of the original row-by-row loader, which left out the spikes
+      and adjustments before the first epoch.
+  """
+  engines = ['Research1', 'Research2']
+  # With use_cache, the second run is read from the sidecars the first wrote.
+  AnticipateRun(engines, epoch_neuron, record_path, use_cache)
+  run = AnticipateRun(engines, epoch_neuron, record_path, use_cache)
+  assert len(run.records) == len(engines)
+  for engine, epochs in zip(engines, run.records):
+    expected = read_reference_epochs(record_path.format(engineName = engine))
+    assert len(expected) > 5
+    assert len(epochs) == len(expected)
+    for epoch, expected_epoch in zip(epochs, expected):
+      assert epoch.engine_name == engine
+      events = [(event.tick, event.neuron_index, event.to_delta(), [(adjustment.neuron_index, adjustment.synapse_index, adjustment.synapse_strength)
+        for adjustment in event.synapse_adjustments]) for event in epoch.events]
+      assert events == [(tick, neuron, delta, [adjustment[:3] for adjustment in adjustments]) for tick, neuron, delta, adjustments in expected_epoch]
+      assert len(epoch.events) == len(expected_epoch)
+      assert epoch.events[-1].tick == expected_epoch[-1][0]
+
+def test_strength_trajectories_match_nested_filter(record_path):
+  """ Each (neuron, synapse) trajectory holds the adjustments to the synapse
+      owned by the neuron's spikes, as the original nested filter over
+      epochs, events and adjustments found them.
+  """
+  run = AnticipateRun(['Research1'], epoch_neuron, record_path, False)
+  record = run.engine_records[0]
+  expected_epochs = read_reference_epochs(record_path.format(engineName = 'Research1'))
+  # Adjustments are owned by the spike before them, of whatever neuron.
+  assert any(adjustment[0] != neuron for epoch in expected_epochs for tick, neuron, delta, adjustments in epoch for adjustment in adjustments)
+
+  for neuron in range(1, 8):
+    for synapse in range(0, 5):
+      expected = []
+      for epoch in expected_epochs:
+        for event in filter(lambda event: event[1] == neuron, epoch):
+          expected.extend(filter(lambda adjustment: adjustment[1] == synapse, event[3]))
+      ticks, strengths = record.get_strength_trajectory(neuron, synapse)
+      assert strengths.tolist() == [adjustment[2] for adjustment in expected]
+      assert ticks.tolist() == [adjustment[3] for adjustment in expected]
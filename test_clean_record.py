@@ -0,0 +1,421 @@
+import os
+import json
+import random
+import functools
+import itertools
+import numpy as np
+import pytest
+import clean_record
+from clean_record import Cleaner, ChangePoints, Records, TriggerSpec, build_activation_matrix
+from support import record_index
+from support.clean_run import load_clean_run, load_epoch_tensor
+from support.record_columns import NOT_AVAILABLE, RecordFilter, empty_records, open_record_cache, merge_record_streams, merge_records, record_sample
+
+
+header = 'tick,time,Neuron-Index,Neuron-Event-Type,Neuron-Activation,Hypersensitive,Synapse-Index,Synapse-Strength\n'
+engines = ['E1', 'E2']
+monitors = [['A', 3], ['B', 4], ['C', 13]]
+
+def write_record(path, ticks, seed, start_tick):
+  """ Write a synthetic engine record: a spike of neuron 1 every 100 ticks,
+      and two random events of other neurons on every tick.
+  """
+  rnd = random.Random(seed)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    f.write(header)
+    for tick in range(start_tick, start_tick + ticks):
+      second = tick // 100
+      time = '2023-01-01 12:%02d:%02d.%09d' % (second // 60 % 60, second % 60, tick % 100 * 10000000 + rnd.randint(0, 999))
+      if tick % 100 == 0:
+        f.write('%d,%s,1,2,100,0,N/A,N/A\n' % (tick, time))
+      for neuron in rnd.sample(range(2, 9), 2):
+        event_type = rnd.choice([1, 2, 3, 4, 5])
+        if event_type == 4:
+          f.write('%d,%s,%d,4,%d,0,%d,%d\n' % (tick, time, neuron, rnd.randint(-50, 100), rnd.randint(0, 3), rnd.randint(-100, 100)))
+        else:
+          f.write('%d,%s,%d,%d,%d,%d,N/A,N/A\n' % (tick, time, neuron, event_type, rnd.randint(-50, 100), rnd.randint(0, 1)))
+
+class RecordConfiguration:
+  """ The parts of a Configuration the cleaner uses, for records under root.
+  """
+  def __init__(self, root):
+    self.root = str(root)
+    self.control = { 'CleanRecordFile': 'CleanRecord.csv' }
+
+  def find_record_path(self):
+    return self.root
+
+  def get_deployment_map(self):
+    return [{ 'engine': engine, 'offset': index * 10 } for index, engine in enumerate(engines)]
+
+def make_records(root, ticks=1500):
+  for index, engine in enumerate(engines):
+    write_record(str(root) + '/' + engine + '/ModelEngineRecord.csv', ticks, index + 1, 100 + 7 * index)
+  return RecordConfiguration(root)
+
+def is_trigger(sample):
+  return sample['Neuron-Event-Type'] == 2 and sample['Neuron-Index'] in (1, 11)
+
+def read_outputs(configuration):
+  """ Return the cleaned run, the text of each epoch file and the epoch
+      manifest's tick ranges, for comparing cleans of the same record.
+  """
+  root = configuration.find_record_path()
+  header, neuron_indices, ticks, matrix = load_clean_run(root + '/CleanRecord.npz')
+  epochs = {}
+  for name in sorted(os.listdir(root)):
+    if name.startswith('epoch') and name.endswith('.csv'):
+      with open(root + '/' + name) as f:
+        epochs[name] = f.read()
+  with open(root + '/CleanRecord.epochs.json') as f:
+    manifest = [(epoch['epoch'], epoch['first_tick'], epoch['end_tick'], epoch['trigger_tick']) for epoch in json.load(f)]
+  return header, neuron_indices.tolist(), ticks.tolist(), matrix, epochs, manifest
+
+def assert_same_outputs(expected, actual):
+  assert expected[0] == actual[0]
+  assert expected[1] == actual[1]
+  assert expected[2] == actual[2]
+  assert np.array_equal(expected[3], actual[3])
+  assert expected[4] == actual[4]
+  assert expected[5] == actual[5]
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+  """ Stream records and build output in small pieces, so chunk and block boundaries fall everywhere.
+  """
+  monkeypatch.setattr(clean_record.RecordFileParser, 'default_chunk_size', 7)
+  monkeypatch.setattr(clean_record.Cleaner, 'block_ticks', 13)
+
+def make_cleaner(configuration, monitoring, trigger=is_trigger, **options):
+  """ A cleaner of the monitored neurons, or of every neuron it discovers.
+  """
+  monitor_neurons = [list(neuron) for neuron in monitors] if monitoring == 'monitored' else None
+  return Cleaner(configuration, monitor_neurons, trigger, **options)
+
+@pytest.fixture(params=['monitored', 'discovered'])
+def monitoring(request):
+  return request.param
+
+@pytest.fixture
+def expected(tmp_path, monitoring):
+  configuration = make_records(tmp_path / 'expected')
+  make_cleaner(configuration, monitoring).clean_data()
+  return read_outputs(configuration)
+
+
+def test_activation_matrix_forward_fills():
+  """ Each row of build_activation_matrix holds every column's last value at or before its tick.
+  """
+  rnd = random.Random(3)
+  ticks = np.sort(np.array([rnd.randint(0, 60) for event in range(200)], dtype=np.int64))
+  columns = np.array([rnd.randint(0, 5) for event in range(200)], dtype=np.int64)
+  values = np.array([rnd.randint(-100, 100) for event in range(200)], dtype=np.int32)
+  state = np.array([1, 2, 3, 4, 5, 6], dtype=np.int32)
+
+  matrix = build_activation_matrix(10, 50, ticks, columns, values, state, np.int32)
+
+  expected = []
+  row = state.tolist()
+  event = 0
+  for tick in range(10, 50):
+    while event < len(ticks) and ticks[event] <= tick:
+      row[columns[event]] = values[event]
+      event += 1
+    expected.append(list(row))
+  assert matrix.tolist() == expected
+  assert state.tolist() == [1, 2, 3, 4, 5, 6]
+
+def test_streaming_clean_matches_default(tmp_path, monitoring, expected, small_chunks):
+  """ Streaming the records in small chunks cleans to the same run and epochs as the default.
+  """
+  configuration = make_records(tmp_path / 'streaming')
+  make_cleaner(configuration, monitoring, streaming=True).clean_data()
+  assert_same_outputs(expected, read_outputs(configuration))
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_samples_match_merged_columns(tmp_path, small_chunks, streaming):
+  """ Reading the records a sample at a time gives the rows of the merged record columns, in order.
+  """
+  configuration = make_records(tmp_path / 'samples', ticks=300)
+  columns = Records(configuration, use_cache=False).load_columns()
+
+  records = Records(configuration, streaming=streaming, use_cache=False)
+  records.create_parsers()
+  samples = []
+  sample = records.get_next_sample()
+  while sample is not None:
+    samples.append(sample)
+    sample = records.get_next_sample()
+
+  assert samples == [record_sample(columns, position) for position in range(len(columns))]
+  assert records.first_tick == int(columns['tick'][0])
+
+def make_stream_parts(count, seed):
+  """ Tick-ordered record arrays with runs of equal ticks, each row's activation numbering it within its part.
+  """
+  rnd = random.Random(seed)
+  parts = []
+  for part in range(count):
+    records = np.zeros(rnd.randint(0, 300), dtype=empty_records().dtype)
+    records['tick'] = np.sort([rnd.randint(0, 100) for row in range(len(records))])
+    records['neuron_index'] = part
+    records['activation'] = np.arange(len(records))
+    parts.append(records)
+  return parts
+
+@pytest.mark.parametrize("count", [1, 2, 5, 16])
+def test_merge_keeps_part_order_at_equal_ticks(count):
+  """ Merging gives the stable tick order of the parts taken in turn, whole or streamed in chunks.
+  """
+  parts = make_stream_parts(count, count)
+  concatenated = np.concatenate(parts)
+  expected = concatenated[np.argsort(concatenated['tick'], kind='stable')]
+  assert np.array_equal(merge_records(parts), expected)
+
+  rnd = random.Random(count)
+  def chunks(records):
+    start = 0
+    while start < len(records):
+      end = start + rnd.randint(1, 40)
+      yield records[start:end]
+      start = end
+  released = list(merge_record_streams([chunks(part) for part in parts]))
+  assert np.array_equal(merge_records(released), expected)
+  for chunk, following in zip(released, released[1:]):
+    assert chunk['tick'][-1] < following['tick'][0]
+
+def test_change_points_expand_to_dense_run(tmp_path, monitoring):
+  """ The sparse change points of a run expand to its dense rows, whole or in part.
+  """
+  dense_configuration = make_records(tmp_path / 'dense')
+  make_cleaner(dense_configuration, monitoring).clean_data()
+  header, neuron_indices, ticks, matrix = load_clean_run(dense_configuration.find_record_path() + '/CleanRecord.npz')
+
+  sparse_configuration = make_records(tmp_path / 'sparse')
+  make_cleaner(sparse_configuration, monitoring, sparse=True).clean_data()
+  change_points = ChangePoints.load(sparse_configuration.find_record_path() + '/CleanRecord.sparse.npz')
+
+  sparse_header, sparse_ticks, sparse_matrix = change_points.expand()
+  assert sparse_header == header
+  assert np.array_equal(sparse_ticks, ticks)
+  assert np.array_equal(sparse_matrix, matrix)
+
+  selected = neuron_indices[::-2].tolist()
+  first_tick = int(ticks[0]) + 250
+  sparse_header, sparse_ticks, sparse_matrix = change_points.expand(selected, first_tick, first_tick + 400)
+  columns = [neuron_indices.tolist().index(index) for index in selected]
+  assert sparse_header == [header[0]] + [header[column + 1] for column in columns]
+  assert np.array_equal(sparse_ticks, ticks[250:650])
+  assert np.array_equal(sparse_matrix, matrix[250:650][:, columns])
+
+def test_change_points_expand_unknown_neuron(tmp_path):
+  configuration = make_records(tmp_path / 'unknown')
+  make_cleaner(configuration, 'monitored', sparse=True).clean_data()
+  change_points = ChangePoints.load(configuration.find_record_path() + '/CleanRecord.sparse.npz')
+  with pytest.raises(ValueError, match='Neuron index 99 '):
+    change_points.expand([3, 99])
+
+def test_parallel_clean_matches_default(tmp_path, monitoring, expected, small_chunks):
+  """ Parsing the record files in a process pool cleans to the same run and epochs as the default.
+  """
+  configuration = make_records(tmp_path / 'parallel')
+  make_cleaner(configuration, monitoring, processes=2).clean_data()
+  assert_same_outputs(expected, read_outputs(configuration))
+
+def sorted_records(records):
+  return np.sort(records, order=['tick', 'neuron_index', 'event_type', 'time'])
+
+@pytest.fixture
+def small_index(monkeypatch):
+  """ Index every 50th record row, so windows start and end between indexed rows.
+  """
+  monkeypatch.setattr(record_index, 'load_record_index', functools.partial(record_index.load_record_index, stride=50))
+
+@pytest.mark.parametrize("use_cache", [False, True], ids=["index", "sidecar"])
+def test_window_query_matches_filtered_load(tmp_path, small_index, use_cache):
+  """ Querying a tick window, from the record index or the sidecar, reads just the rows a full load would keep.
+  """
+  configuration = make_records(tmp_path / 'query')
+  columns = Records(configuration, use_cache=use_cache).load_columns()
+  for path in Records(configuration).get_record_files():
+    assert (open_record_cache(path) is not None) == use_cache
+
+  for first_tick, end_tick in [(None, 300), (450, 1000), (1390, None), (5000, 6000)]:
+    window = merge_records(list(Records(configuration, use_cache=use_cache).query(first_tick, end_tick)))
+    expected = RecordFilter(first_tick=first_tick, end_tick=end_tick).select(columns)
+    assert np.array_equal(sorted_records(window), sorted_records(expected))
+
+@pytest.mark.parametrize("use_cache", [False, True], ids=["index", "sidecar"])
+def test_time_window_query_matches_filtered_load(tmp_path, small_index, use_cache):
+  """ Querying a time window, alone or within a tick window, reads just the rows in it.
+  """
+  configuration = make_records(tmp_path / 'query')
+  columns = Records(configuration, use_cache=use_cache).load_columns()
+  times = np.sort(columns['time'])
+  windows = [(None, times[300]), (times[1000], times[2500]), (times[-40], None), (times[-1] + 1, None)]
+  for first_time, end_time in windows:
+    in_time = np.ones(len(columns), dtype=bool)
+    if first_time is not None:
+      in_time &= columns['time'] >= first_time
+    if end_time is not None:
+      in_time &= columns['time'] < end_time
+
+    window = merge_records(list(Records(configuration, use_cache=use_cache).query(first_time=first_time, end_time=end_time)))
+    assert np.array_equal(sorted_records(window), sorted_records(columns[in_time]))
+
+    window = merge_records(list(Records(configuration, use_cache=use_cache).query(400, 1200, first_time, end_time)))
+    expected = columns[in_time & (columns['tick'] >= 400) & (columns['tick'] < 1200)]
+    assert np.array_equal(sorted_records(window), sorted_records(expected))
+
+def test_followed_clean_matches_batch(tmp_path, monitoring, expected):
+  """ Following records as they are written, in pieces that split rows, cleans to the same run and epochs.
+  """
+  configuration = make_records(tmp_path / 'followed')
+  engine_pieces = []
+  for engine in engines:
+    path = configuration.find_record_path() + '/' + engine + '/ModelEngineRecord.csv'
+    with open(path) as f:
+      text = f.read()
+    open(path, 'w').close()
+    engine_pieces.append([(path, text[start:start + 5001]) for start in range(0, len(text), 5001)])
+  pieces = [piece for pieces in itertools.zip_longest(*engine_pieces) for piece in pieces if piece is not None]
+
+  # Append one piece per poll, stopping once the last has been polled.
+  def write_next_piece():
+    if not pieces:
+      return True
+    path, text = pieces.pop(0)
+    with open(path, 'a') as f:
+      f.write(text)
+    return False
+
+  make_cleaner(configuration, monitoring).follow_data(poll_interval=0, idle_timeout=60, stop_callback=write_next_piece)
+  assert_same_outputs(expected, read_outputs(configuration))
+
+def test_trigger_spec_matches_callback(tmp_path, monitoring, expected):
+  configuration = make_records(tmp_path / 'spec')
+  make_cleaner(configuration, monitoring, TriggerSpec([clean_record.NeuronRecordType.Spike.value], [1, 11])).clean_data()
+  assert_same_outputs(expected, read_outputs(configuration))
+
+def test_checkpointed_clean_matches_default(tmp_path, monitoring, expected, small_chunks):
+  configuration = make_records(tmp_path / 'checkpointed')
+  make_cleaner(configuration, monitoring).clean_data(checkpoint_interval=0)
+  assert_same_outputs(expected, read_outputs(configuration))
+  assert not os.path.exists(str(tmp_path / 'checkpointed' / 'CleanRecord.checkpoint'))
+
+@pytest.mark.parametrize("crash_at", [3, 60, 250])
+def test_resumed_clean_matches_default(tmp_path, monitoring, expected, small_chunks, crash_at):
+  """ A checkpointed clean interrupted part way, then run again, resumes to the same run and epochs.
+  """
+  configuration = make_records(tmp_path / 'resumed')
+  cleaner = make_cleaner(configuration, monitoring)
+  clean_columns = cleaner.clean_columns
+  calls = []
+  def interrupted_clean_columns(columns):
+    calls.append(len(columns))
+    if len(calls) == crash_at:
+      raise KeyboardInterrupt()
+    clean_columns(columns)
+  cleaner.clean_columns = interrupted_clean_columns
+  with pytest.raises(KeyboardInterrupt):
+    cleaner.clean_data(checkpoint_interval=0)
+  assert os.path.exists(str(tmp_path / 'resumed' / 'CleanRecord.checkpoint' / 'checkpoint.json'))
+
+  make_cleaner(configuration, monitoring).clean_data(checkpoint_interval=0)
+  assert_same_outputs(expected, read_outputs(configuration))
+
+@pytest.mark.parametrize("epoch_length", [None, 40, 150])
+def test_epoch_tensor_matches_run(tmp_path, monitoring, small_chunks, epoch_length):
+  """ Each epoch of the tensor holds the run's rows over the epoch's manifest range, truncated or zero-padded to epoch_length.
+  """
+  configuration = make_records(tmp_path / 'tensor')
+  make_cleaner(configuration, monitoring, export_epoch_tensor=True, epoch_length=epoch_length).clean_data()
+  root = configuration.find_record_path()
+  header, neuron_indices, ticks, matrix = load_clean_run(root + '/CleanRecord.npz')
+  with open(root + '/CleanRecord.epochs.json') as f:
+    manifest = json.load(f)
+  tensor, sidecar = load_epoch_tensor(root + '/CleanRecord.epochs.npy')
+
+  lengths = [epoch['end_tick'] - epoch['first_tick'] for epoch in manifest]
+  length = max(lengths) if epoch_length is None else epoch_length
+  assert len(manifest) > 2
+  assert tensor.shape == (len(manifest), length, len(neuron_indices))
+  assert sidecar['neurons'] == header[1:]
+  assert sidecar['neuron_indices'] == neuron_indices.tolist()
+  assert sidecar['lengths'] == lengths
+  assert sidecar['first_ticks'] == [epoch['first_tick'] for epoch in manifest]
+  assert sidecar['trigger_ticks'] == [epoch['trigger_tick'] for epoch in manifest]
+
+  for number, epoch in enumerate(manifest):
+    rows = matrix[(ticks >= epoch['first_tick']) & (ticks < min(epoch['end_tick'], epoch['first_tick'] + length))]
+    assert np.array_equal(tensor[number, :len(rows)], rows)
+    assert not tensor[number, len(rows):].any()
+  # Epochs are long and short in turn, so some are always padded, and at 40 ticks the others truncated.
+  assert min(lengths) < length
+  assert epoch_length != 40 or max(lengths) > length
+
+def test_epoch_tensor_needs_dense_output(tmp_path):
+  with pytest.raises(ValueError):
+    make_cleaner(make_records(tmp_path / 'sparse', ticks=10), 'monitored', sparse=True, export_epoch_tensor=True)
+
+def reference_rows(events, ticks, width):
+  """ For each of ticks, a row of each column's last value among the (tick, column, value) events at or before it, from zero.
+  """
+  rows = []
+  row = [0] * width
+  event = 0
+  for tick in ticks:
+    while event < len(events) and events[event][0] <= tick:
+      row[events[event][1]] = events[event][2]
+      event += 1
+    rows.append(list(row))
+  return rows
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_channels_match_row_by_row(tmp_path, monitoring, small_chunks, streaming):
+  """ The hypersensitive and synapse strength channels hold, for every tick of the run, the last value of each column.
+  """
+  configuration = make_records(tmp_path / 'channels', ticks=600)
+  make_cleaner(configuration, monitoring, streaming=streaming, channels=['hypersensitive', 'synapse_strength']).clean_data()
+  root = configuration.find_record_path()
+  header, neuron_indices, ticks, matrix = load_clean_run(root + '/CleanRecord.npz')
+  columns = Records(configuration, use_cache=False).load_columns()
+  monitor_columns = { index: column for column, index in enumerate(neuron_indices.tolist()) }
+
+  hypersensitive_events = []
+  synapse_events = []
+  synapse_columns = {}
+  for row in columns:
+    tick, event_type, neuron = int(row['tick']), int(row['event_type']), int(row['neuron_index'])
+    if neuron not in monitor_columns:
+      continue
+    if event_type in (1, 2, 3, 4, 5):
+      hypersensitive_events.append((tick, monitor_columns[neuron], int(row['hypersensitive'])))
+    if event_type == 4 and row['synapse_index'] != NOT_AVAILABLE:
+      key = (neuron, int(row['synapse_index']))
+      synapse_columns.setdefault(key, len(synapse_columns))
+      synapse_events.append((tick, synapse_columns[key], int(row['synapse_strength'])))
+
+  channel_header, channel_neurons, channel_ticks, channel_matrix = load_clean_run(root + '/CleanRecord.hypersensitive.npz')
+  assert channel_header == header
+  assert np.array_equal(channel_neurons, neuron_indices)
+  assert np.array_equal(channel_ticks, ticks)
+  assert channel_matrix.tolist() == reference_rows(hypersensitive_events, ticks.tolist(), len(neuron_indices))
+
+  keys = list(synapse_columns)
+  channel_header, channel_neurons, channel_ticks, channel_matrix = load_clean_run(root + '/CleanRecord.synapse_strength.npz')
+  with np.load(root + '/CleanRecord.synapse_strength.npz') as data:
+    synapse_indices = data['synapse_indices'].tolist()
+  assert channel_header == ['time'] + [header[monitor_columns[neuron] + 1] + '/' + str(synapse) for neuron, synapse in keys]
+  assert channel_neurons.tolist() == [neuron for neuron, synapse in keys]
+  assert synapse_indices == [synapse for neuron, synapse in keys]
+  assert np.array_equal(channel_ticks, ticks)
+  assert channel_matrix.tolist() == reference_rows(synapse_events, ticks.tolist(), len(keys))
+
+def test_channels_need_dense_uncheckpointed_cleaning(tmp_path):
+  configuration = make_records(tmp_path / 'channels', ticks=10)
+  with pytest.raises(ValueError):
+    make_cleaner(configuration, 'monitored', sparse=True, channels=['hypersensitive'])
+  with pytest.raises(ValueError):
+    make_cleaner(configuration, 'monitored', channels=['synapse_strength']).clean_data(checkpoint_interval=0)
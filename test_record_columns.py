@@ -0,0 +1,112 @@
+import random
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from support import record_columns
+from support.record_columns import RecordFilter, decode_timestamps, filter_records, iter_record_columns, load_record_columns, load_record_columns_parallel, open_record_cache
+
+
+header = 'tick,time,Neuron-Index,Neuron-Event-Type,Neuron-Activation,Hypersensitive,Synapse-Index,Synapse-Strength\n'
+
+def reference_timestamp(time):
+  """ A record timestamp decoded one at a time: the whole seconds since
+      1970-01-01, and the digits after the '.' as nanoseconds.
+  """
+  prefix, nanoseconds = time.split('.')
+  seconds = (datetime.fromisoformat(prefix) - datetime(1970, 1, 1)) // timedelta(seconds=1)
+  return seconds * 1000000000 + int(nanoseconds)
+
+def make_times(count, seed, digits=9):
+  rnd = random.Random(seed)
+  moment = datetime(2023, 1, 1, 23, 59, 50)
+  times = []
+  for row in range(count):
+    moment += timedelta(microseconds=rnd.randint(0, 300000))
+    fraction = str(rnd.randint(0, 10 ** digits - 1)).zfill(digits)
+    times.append(moment.strftime('%Y-%m-%d %H:%M:%S') + '.' + fraction)
+  return times
+
+@pytest.fixture
+def record_file(tmp_path):
+  rnd = random.Random(7)
+  path = str(tmp_path / 'ModelEngineRecord.csv')
+  with open(path, 'w') as f:
+    f.write(header)
+    for tick, time in enumerate(make_times(3000, 7), start=100):
+      if rnd.random() < 0.3:
+        f.write('%d,%s,%d,4,%d,0,%d,%d\n' % (tick, time, rnd.randint(0, 9), rnd.randint(-50, 50), rnd.randint(0, 3), rnd.randint(-100, 100)))
+      f.write('%d,%s,%d,%d,%d,%d,N/A,N/A\n' % (tick, time, rnd.randint(0, 9), rnd.choice([0, 1, 2, 3, 5]), rnd.randint(-50, 50), rnd.randint(0, 1)))
+  return path
+
+
+@pytest.mark.parametrize("digits", [9, 6])
+def test_decode_timestamps_matches_fromisoformat(digits):
+  times = make_times(2000, digits, digits)
+  decoded = decode_timestamps(np.array(times, dtype=object))
+  assert decoded.dtype == np.int64
+  assert decoded.tolist() == [reference_timestamp(time) for time in times]
+
+def test_decode_timestamps_of_mixed_layouts():
+  """ Timestamps that do not share one layout are decoded one prefix at a time instead.
+  """
+  times = make_times(500, 1) + make_times(500, 2, 3) + ['2023-01-02 00:00:00.5']
+  decoded = decode_timestamps(np.array(times, dtype=object))
+  assert decoded.tolist() == [reference_timestamp(time) for time in times]
+
+def test_decode_timestamps_of_nothing():
+  assert len(decode_timestamps(np.array([], dtype=object))) == 0
+
+def test_sidecar_serves_later_loads(record_file):
+  """ The first cached load writes the sidecar, which is used until the record file changes.
+  """
+  columns = load_record_columns(record_file, False)
+  assert open_record_cache(record_file) is None
+  assert np.array_equal(load_record_columns(record_file, True), columns)
+  assert np.array_equal(open_record_cache(record_file), columns)
+  assert np.array_equal(np.concatenate(list(iter_record_columns(record_file, 500, True))), columns)
+
+  with open(record_file, 'a') as f:
+    f.write('5000,2023-01-02 00:10:00.000000000,3,2,100,0,N/A,N/A\n')
+  assert open_record_cache(record_file) is None
+  assert len(load_record_columns(record_file, True)) == len(columns) + 1
+
+def test_interrupted_parse_writes_no_sidecar(record_file):
+  chunks = iter_record_columns(record_file, 500, True)
+  next(chunks)
+  chunks.close()
+  assert open_record_cache(record_file) is None
+
+def test_filtered_parse_writes_cache(record_file):
+  """ A filtered first parse still writes the sidecar of every row, which later loads are served from.
+  """
+  record_filter = RecordFilter(event_types=[4], neurons=[range(2, 5)])
+  columns = load_record_columns(record_file, False)
+  filtered = load_record_columns(record_file, True, record_filter)
+  assert np.array_equal(filtered, filter_records(columns, record_filter))
+  assert np.array_equal(open_record_cache(record_file), columns)
+  assert np.array_equal(load_record_columns(record_file, True, record_filter), filtered)
+
+@pytest.mark.parametrize("range_size", [4000, 1 << 25])
+def test_parallel_parse_matches_load(record_file, monkeypatch, range_size):
+  """ Parsing a record file by byte ranges across processes gives the same columns as one parse.
+  """
+  monkeypatch.setattr(record_columns, 'parallel_range_size', range_size)
+  record_filter = RecordFilter(event_types=[2, 4])
+  columns = load_record_columns(record_file, False)
+  assert np.array_equal(load_record_columns_parallel(record_file, False, 2), columns)
+  assert np.array_equal(load_record_columns_parallel(record_file, True, 2, record_filter), filter_records(columns, record_filter))
+  assert np.array_equal(open_record_cache(record_file), columns)
+
+def test_filter_matches_selection(record_file):
+  """ Filtering as the columns are parsed keeps just the rows that pass, chunked or not.
+  """
+  columns = load_record_columns(record_file, False)
+  cases = [
+    (RecordFilter(event_types=[2]), lambda row: row['event_type'] == 2),
+    (RecordFilter(neurons=[3, range(6, 8)], first_tick=500), lambda row: row['neuron_index'] in (3, 6, 7) and row['tick'] >= 500),
+    (RecordFilter(event_types=[1, 4], end_tick=120), lambda row: row['event_type'] in (1, 4) and row['tick'] < 120)
+  ]
+  for record_filter, passes in cases:
+    expected = columns[[bool(passes(row)) for row in columns]]
+    assert np.array_equal(load_record_columns(record_file, False, record_filter), expected)
+    assert np.array_equal(np.concatenate(list(iter_record_columns(record_file, 500, False, record_filter))), expected)
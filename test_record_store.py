@@ -0,0 +1,65 @@
+import random
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import pytest
+from support.record_columns import RecordFilter, load_record_columns
+from support.record_store import RecordStore, attach_record_store, get_shared_records
+
+
+header = 'tick,time,Neuron-Index,Neuron-Event-Type,Neuron-Activation,Hypersensitive,Synapse-Index,Synapse-Strength\n'
+
+def write_record(path, seed, rows=2000):
+  rnd = random.Random(seed)
+  with open(path, 'w') as f:
+    f.write(header)
+    for row in range(rows):
+      tick = 100 + row // 3
+      f.write('%d,2023-01-01 12:00:%02d.%09d,%d,%d,%d,0,N/A,N/A\n' % (tick, tick // 100 % 60, rnd.randint(0, 999999999), rnd.randint(0, 9), rnd.randint(1, 3), rnd.randint(-50, 100)))
+
+def read_shared_records(name):
+  """ In a pool worker: a copy of the stored records, and whether writing to the view was refused.
+  """
+  records = get_shared_records(name)
+  try:
+    records['activation'][0] = 1
+    refused = False
+  except ValueError:
+    refused = True
+  return records.copy(), refused
+
+@pytest.fixture
+def record_files(tmp_path):
+  filenames = [str(tmp_path / ('ModelEngineRecord' + str(index) + '.csv')) for index in range(2)]
+  for seed, filename in enumerate(filenames):
+    write_record(filename, seed)
+  return filenames
+
+
+def test_workers_share_read_only_records(record_files):
+  """ Pool workers attached to the store see the loaded records, read-only, and close() frees their blocks.
+  """
+  record_filter = RecordFilter(event_types=[2])
+  store = RecordStore()
+  views = store.load(record_files, names=['first', 'second'], use_cache=False, record_filters=[None, record_filter])
+  expected = [load_record_columns(record_files[0], False), load_record_columns(record_files[1], False, record_filter)]
+  try:
+    assert np.array_equal(views[0], expected[0])
+    assert np.array_equal(store.get('second'), expected[1])
+    with pytest.raises(ValueError):
+      store.add('first', expected[0])
+
+    with multiprocessing.Pool(2, initializer=attach_record_store, initargs=(store.get_handles(),)) as pool:
+      shared = pool.map(read_shared_records, ['first', 'second', 'first'])
+    for (records, refused), source in zip(shared, expected + expected[:1]):
+      assert refused
+      assert np.array_equal(records, source)
+    assert np.array_equal(store.get('first'), expected[0])
+  finally:
+    block_names = [handle['block'] for handle in store.get_handles().values()]
+    store.close()
+
+  assert len(block_names) == 2
+  for block_name in block_names:
+    with pytest.raises(FileNotFoundError):
+      shared_memory.SharedMemory(name=block_name)
@@ -0,0 +1,104 @@
+import random
+import numpy as np
+import pytest
+from analysis.spike_analytics import get_spike_trains, get_spike_times, get_interspike_intervals, get_firing_rates, get_spike_latencies, get_cross_correlogram, get_epoch_first_spikes
+
+
+class SpikeRecord:
+  """ The event arrays of an AnticipateRecord that the analytics use: random
+      spikes of neurons 1 to 5, with an epoch at each spike of neuron 1.
+  """
+  def __init__(self, seed, count=400):
+    rnd = random.Random(seed)
+    self.ticks = np.sort(np.array([rnd.randint(0, 2000) for spike in range(count)], dtype=np.int64))
+    self.times = self.ticks * 1000000 + np.array([rnd.randint(0, 999) for spike in range(count)], dtype=np.int64)
+    self.neuron_indices = np.array([rnd.choice([1, 2, 2, 3, 4, 5]) for spike in range(count)], dtype=np.int32)
+    self.epoch_starts = np.flatnonzero(self.neuron_indices == 1)
+    self.epoch_ends = np.append(self.epoch_starts[1:], len(self.ticks))
+
+@pytest.fixture
+def record():
+  return SpikeRecord(5)
+
+
+def test_spike_trains_and_intervals(record):
+  trains = get_spike_trains(record)
+  assert list(trains) == [1, 2, 3, 4, 5]
+  for neuron, train in trains.items():
+    expected = [int(tick) for tick, index in zip(record.ticks, record.neuron_indices) if index == neuron]
+    assert train.tolist() == expected
+    assert get_interspike_intervals(trains)[neuron].tolist() == [second - first for first, second in zip(expected, expected[1:])]
+
+  times = get_spike_times(record, [3, 9])
+  assert times[3].tolist() == [int(time) for time, index in zip(record.times, record.neuron_indices) if index == 3]
+  assert len(times[9]) == 0
+
+@pytest.mark.parametrize("window,step,first_tick,end_tick", [
+  (50, 1, None, None),
+  (100, 7, None, None),
+  (30, 30, 500, 800),
+  (5000, 1, None, None),
+  (20, 3, 1990, 2050)
+])
+def test_firing_rates_count_spikes_per_window(record, window, step, first_tick, end_tick):
+  """ Windows start every step ticks from the first tick, the last ending at or before the end tick, and count the spikes within them.
+  """
+  trains = get_spike_trains(record, [2, 4, 7])
+  window_ticks, rates = get_firing_rates(trains, window, step, first_tick, end_tick)
+
+  first = first_tick if first_tick is not None else int(record.ticks[np.isin(record.neuron_indices, [2, 4])][0])
+  end = end_tick if end_tick is not None else int(record.ticks[np.isin(record.neuron_indices, [2, 4])][-1]) + 1
+  expected_ticks = list(range(first, end - window + 1, step)) or [first]
+  assert window_ticks.tolist() == expected_ticks
+  for row, start in enumerate(expected_ticks):
+    for column, train in enumerate(trains.values()):
+      assert rates[row, column] == sum(1 for tick in train.tolist() if start <= tick < start + window) / window
+
+def test_firing_rates_of_no_spikes():
+  window_ticks, rates = get_firing_rates({ 1: np.empty(0, dtype=np.int64) }, 10)
+  assert window_ticks.tolist() == [0]
+  assert rates.tolist() == [[0.0]]
+
+@pytest.mark.parametrize("max_latency", [None, 0, 15])
+def test_spike_latencies_find_next_target_spike(record, max_latency):
+  trains = get_spike_trains(record)
+  # Leave the last source spikes with no target spike after them.
+  targets = trains[5][:-10]
+  latencies = get_spike_latencies(trains[3], targets, max_latency)
+  expected = []
+  for source in trains[3].tolist():
+    following = [target - source for target in targets.tolist() if target >= source]
+    latency = min(following) if following else -1
+    expected.append(-1 if max_latency is not None and latency > max_latency else latency)
+  assert latencies.tolist() == expected
+  assert -1 in expected
+
+def test_spike_latencies_with_no_targets(record):
+  sources = get_spike_trains(record)[3]
+  assert get_spike_latencies(sources, np.empty(0, dtype=np.int64)).tolist() == [-1] * len(sources)
+
+@pytest.mark.parametrize("max_lag", [0, 1, 25])
+def test_cross_correlogram_counts_pairs_by_lag(record, max_lag):
+  trains = get_spike_trains(record)
+  lags, counts = get_cross_correlogram(trains[2], trains[4], max_lag)
+  assert lags.tolist() == list(range(-max_lag, max_lag + 1))
+  for lag, count in zip(lags.tolist(), counts.tolist()):
+    assert count == sum(1 for source in trains[2].tolist() for target in trains[4].tolist() if target - source == lag)
+
+def test_cross_correlogram_with_no_pairs():
+  lags, counts = get_cross_correlogram(np.array([10], dtype=np.int64), np.array([100], dtype=np.int64), 5)
+  assert counts.tolist() == [0] * 11
+
+def test_epoch_first_spikes_measure_from_the_trigger(record):
+  """ Each epoch's first spike of each neuron is timed from the epoch's trigger spike, or -1 if the neuron does not spike in it.
+  """
+  neurons = [1, 3, 5, 8]
+  latencies = get_epoch_first_spikes(record, neurons)
+  assert latencies.shape == (len(record.epoch_starts), len(neurons))
+  for epoch, (start, end) in enumerate(zip(record.epoch_starts.tolist(), record.epoch_ends.tolist())):
+    for column, neuron in enumerate(neurons):
+      spikes = [int(record.ticks[position]) for position in range(start, end) if record.neuron_indices[position] == neuron]
+      assert latencies[epoch, column] == (spikes[0] - int(record.ticks[start]) if spikes else -1)
+  assert (latencies[:, 0] == 0).all()
+  assert (latencies[:, 1] == -1).any()
+  assert (latencies[:, 3] == -1).all()
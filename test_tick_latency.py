@@ -0,0 +1,79 @@
+import os
+import math
+from datetime import datetime, timedelta
+import pytest
+from analysis.tick_latency import TickLatencyRun, get_tick_starts
+
+
+header = 'tick,time,Neuron-Index,Neuron-Event-Type,Neuron-Activation,Hypersensitive,Synapse-Index,Synapse-Strength\n'
+period = 1000
+
+# The microseconds after the start of the run of each row, by tick.  Ticks
+# 13, 14 and 20 to 24 have no rows, and tick 16's rows are out of order.
+row_times = {
+  10: [0, 10, 20],
+  11: [1000, 1400],
+  12: [2000],
+  15: [8000, 8100],
+  16: [9600, 9500, 9700],
+  17: [10400],
+  18: [15400, 15900],
+  19: [16400],
+  25: [22400, 22450]
+}
+
+# The duration of each tick in microseconds, gap ticks sharing their interval evenly.
+tick_durations = [1000, 1000, 2000, 2000, 2000, 1500, 900, 5000, 1000, 1000, 1000, 1000, 1000, 1000, 1000]
+
+def write_record(path):
+  start = datetime(2023, 1, 1, 12, 0, 0)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    f.write(header)
+    for tick, times in row_times.items():
+      for row, microseconds in enumerate(times):
+        moment = start + timedelta(microseconds=microseconds)
+        f.write('%d,%s.%09d,%d,1,0,0,N/A,N/A\n' % (tick, moment.strftime('%Y-%m-%d %H:%M:%S'), moment.microsecond * 1000 + 7, row))
+
+@pytest.fixture
+def record_path(tmp_path):
+  write_record(str(tmp_path) + '/Research1/ModelEngineRecord.csv')
+  return str(tmp_path) + '/{engineName}/ModelEngineRecord.csv'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 1 << 20])
+def test_tick_starts_are_earliest_row_times(record_path, chunk_size):
+  """ Each observed tick starts at its earliest row's time, however the record is split into chunks.
+  """
+  ticks, times = get_tick_starts(record_path.format(engineName = 'Research1'), chunk_size, use_cache=False)
+  assert ticks.tolist() == list(row_times)
+  assert ((times - times[0]) // 1000).tolist() == [min(microseconds) for microseconds in row_times.values()]
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_report_matches_per_tick_durations(record_path, use_cache):
+  """ Spans over gap ticks count every tick, so the percentiles, overruns,
+      histogram and mean are those of the per-tick durations.
+  """
+  run = TickLatencyRun([{ 'name': 'Research1', 'period': period }], record_path, use_cache, worst_count=3, bins=8, histogram_periods=4)
+  report = run.reports[0]
+
+  assert report.spans.tolist() == [1, 1, 3, 1, 1, 1, 1, 6]
+  assert report.tick_count == len(tick_durations)
+  assert [round(duration) for duration in report.durations.tolist()] == [1000, 1000, 2000, 1500, 900, 5000, 1000, 1000]
+  assert report.mean == pytest.approx(22400 / len(tick_durations))
+  assert report.maximum == pytest.approx(5000)
+
+  # Nearest rank over the sorted per-tick durations.
+  ordered = sorted(tick_durations)
+  for percentile, duration in report.percentiles.items():
+    assert round(duration) == ordered[math.ceil(percentile / 100 * len(ordered)) - 1]
+  assert sorted(report.percentiles) == [50, 90, 99, 99.9]
+
+  assert report.overrun_count == sum(1 for duration in tick_durations if duration > period * 1.1)
+  assert report.overrun_count == 5
+  assert [(tick, span, round(duration)) for tick, span, duration in report.worst_stalls] == [(17, 1, 5000), (12, 3, 2000), (15, 1, 1500)]
+  assert report.histogram.tolist() == [0, 1, 9, 1, 3, 0, 0, 0]
+  assert report.histogram_overflow == 1
+  assert report.final_drift == pytest.approx(22400 - (25 - 10) * period)
+  assert report.drift.tolist() == pytest.approx([min(microseconds) - (tick - 10) * period for tick, microseconds in row_times.items()])
+  run.print()